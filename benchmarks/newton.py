@@ -0,0 +1,69 @@
+import deltapv as dpv
+from deltapv import simulator, solver, adjoint
+import argparse
+import time
+
+material = dpv.create_material(Chi=3.9,
+                               Eg=1.5,
+                               eps=9.4,
+                               Nc=8e17,
+                               Nv=1.8e19,
+                               mn=100,
+                               mp=100,
+                               Et=0,
+                               tn=1e-8,
+                               tp=1e-8,
+                               A=1e4)
+
+MODES = {
+    "assembled": dpv.SolverOptions(),
+    "assembled, reused ILU": dpv.SolverOptions(reuse_precond=True),
+    "jacobian-free": dpv.SolverOptions(linsolver="jfnk"),
+    "assembled, EW forcing": dpv.SolverOptions(reuse_precond=True,
+                                               forcing="ew"),
+    "jacobian-free, EW forcing": dpv.SolverOptions(linsolver="jfnk",
+                                                   forcing="ew")
+}
+
+
+def sweep(des, opts, n_steps=10):
+    # Newton and GMRES iterations along a short sweep with linear continuation
+    ls = simulator.incident_light()
+    cell = simulator.init_cell(des, ls)
+    pot_eq = simulator.equilibrium(des, ls, opts)
+    pot = solver.ooe_guess(cell, pot_eq)
+    state = solver.SolverState()
+    dv = solver.vincr(cell)
+    niter, lin_iters = 0, 0
+    for i in range(n_steps):
+        _, pot = adjoint.solve_pdd(cell, i * dv, pot, opts, state)
+        niter += state.stats["niter"]
+        lin_iters += state.stats.get("linear_iters", 0)
+    return niter, lin_iters if solver.iterative(opts) else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_points", type=int, default=500)
+    args = parser.parse_args()
+    dpv.logger.setLevel("WARNING")
+
+    des = dpv.make_design(n_points=args.n_points,
+                          Ls=[5e-6, 3e-4 - 5e-6],
+                          mats=[material, material],
+                          Ns=[1e17, -1e15],
+                          Snl=1e7,
+                          Snr=0,
+                          Spl=0,
+                          Spr=1e7)
+
+    for name, opts in MODES.items():
+        dpv.simulate(des, verbose=False, opts=opts)  # compile
+        t = time.time()
+        results = dpv.simulate(des, verbose=False, opts=opts)
+        wall = time.time() - t
+        niter, lin_iters = sweep(des, opts)
+        lin_iters = "-" if lin_iters is None else lin_iters
+        print(f"{name:>26}: eff = {results['eff']:.6f}, "
+              f"{wall:6.2f} s per sweep, {niter:4d} Newton iterations, "
+              f"{lin_iters:>4} GMRES iterations")
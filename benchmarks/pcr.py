@@ -0,0 +1,67 @@
+import deltapv as dpv
+from deltapv import simulator, solver, residual, linalg, bcond
+from jax import jit
+import argparse
+import time
+
+material = dpv.create_material(Chi=3.9,
+                               Eg=1.5,
+                               eps=9.4,
+                               Nc=8e17,
+                               Nv=1.8e19,
+                               mn=100,
+                               mp=100,
+                               Et=0,
+                               tn=1e-8,
+                               tp=1e-8,
+                               A=1e4)
+
+SOLVERS = {
+    "ILU + GMRES": jit(lambda m, b: linalg.linsol(m, b, tol=1e-6)),
+    "block Thomas": linalg.btsol,
+    "banded LU": linalg.bandsol,
+    "cyclic reduction": linalg.pcrsol
+}
+
+
+def jacobian(n_points):
+    # PDD Jacobian at the out-of-equilibrium guess for short circuit
+    des = dpv.make_design(n_points=n_points,
+                          Ls=[5e-6, 3e-4 - 5e-6],
+                          mats=[material, material],
+                          Ns=[1e17, -1e15],
+                          Snl=1e7,
+                          Snr=0,
+                          Spl=0,
+                          Spr=1e7)
+    ls = simulator.incident_light()
+    cell = simulator.init_cell(des, ls)
+    pot = solver.ooe_guess(cell, simulator.equilibrium(des, ls))
+    bound = bcond.boundary(cell, 0.)
+    F = residual.comp_F(cell, bound, pot)
+    spJ = residual.comp_F_deriv(cell, bound, pot)
+    return spJ, -F
+
+
+def timeit(fun, *args, repeat=10):
+    fun(*args).block_until_ready()
+    t = time.time()
+    for _ in range(repeat):
+        fun(*args).block_until_ready()
+    return (time.time() - t) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",
+                        type=int,
+                        nargs="+",
+                        default=[100, 300, 1000, 3000, 10000])
+    args = parser.parse_args()
+    dpv.logger.setLevel("WARNING")
+
+    print("{:>8}".format("N") + "".join(f"{name:>18}" for name in SOLVERS))
+    for n in args.sizes:
+        spJ, rhs = jacobian(n)
+        times = [timeit(fun, spJ, rhs) for fun in SOLVERS.values()]
+        print(f"{n:>8}" + "".join(f"{1e3 * t:>15.2f} ms" for t in times))
@@ -0,0 +1,43 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = """
+import deltapv as dpv
+material = dpv.create_material(Chi=3.9, Eg=1.5, eps=9.4, Nc=8e17, Nv=1.8e19,
+                               mn=100, mp=100, Et=0, tn=1e-8, tp=1e-8, A=1e4)
+des = dpv.make_design(n_points={n_points}, Ls=[5e-6, 3e-4 - 5e-6],
+                      mats=[material, material], Ns=[1e17, -1e15], Snl=1e7,
+                      Snr=0, Spl=0, Spr=1e7)
+dpv.logger.setLevel("WARNING")
+dpv.simulate(des, verbose=False)
+"""
+
+
+def run(n_points, cache=None):
+    # wall time of a fresh interpreter importing deltapv and simulating once
+    env = dict(os.environ)
+    env.pop("DELTAPV_CACHE", None)
+    if cache is not None:
+        env["DELTAPV_CACHE"] = cache
+    t = time.time()
+    subprocess.run([sys.executable, "-c",
+                    SCRIPT.format(n_points=n_points)],
+                   env=env,
+                   check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.time() - t
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_points", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache:
+        print(f"no cache     {run(args.n_points):8.2f} s")
+        print(f"cold cache   {run(args.n_points, cache):8.2f} s")
+        print(f"warm cache   {run(args.n_points, cache):8.2f} s")
@@ -5,6 +5,10 @@ if os.environ.get("DEBUGNANS") == "TRUE":
     config.update("jax_debug_nans", True)
 if os.environ.get("NOJIT") == "TRUE":
     config.update('jax_disable_jit', True)
+if os.environ.get("DELTAPV_CACHE"):
+    # persist compiled kernels across processes, including the short ones
+    config.update("jax_compilation_cache_dir", os.environ["DELTAPV_CACHE"])
+    config.update("jax_persistent_cache_min_compile_time_secs", 0)
 
 import logging
 logging.basicConfig(format="")
@@ -12,7 +16,7 @@ logger = logging.getLogger("deltapv")
 logger.setLevel("INFO")
 
 from deltapv import simulator, materials, plotting, objects, spline, physics, util
-from deltapv.simulator import make_design, incident_light, equilibrium, simulate, eff_at_bias, empty_design, add_material, doping, contacts
+from deltapv.simulator import make_design, pad_design, incident_light, equilibrium, simulate, simulate_iter, mpp, jsc, voc, sweep, sweep_parallel, simulate_batch, eff_and_grad, iv_jacobian, eff_at_bias, eff_hvp, SolverOptions, empty_design, add_material, doping, contacts
 from deltapv.materials import create_material, load_material
 from deltapv.plotting import plot_band_diagram, plot_bars, plot_charge, plot_iv_curve
 
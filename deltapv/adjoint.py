@@ -1,22 +1,31 @@
 from deltapv import objects, solver, bcond, current, residual, linalg, scales, util
-from jax import numpy as jnp, custom_jvp, jvp, jacfwd, jacrev, jit
+from jax import numpy as jnp, custom_jvp, custom_vjp, jvp, vjp, jacfwd, jacrev, jit, tree_util
+from functools import partial
 import matplotlib.pyplot as plt
 import logging
 logger = logging.getLogger("deltapv")
 
 PVCell = objects.PVCell
 Potentials = objects.Potentials
+SolverOptions = objects.SolverOptions
+SolverState = solver.SolverState
 Array = util.Array
 f64 = util.f64
 
 
-def solve_pdd(cell: PVCell, v: f64, pot_ini: Potentials):
+def solve_pdd(cell: PVCell,
+              v: f64,
+              pot_ini: Potentials,
+              opts: SolverOptions = SolverOptions(),
+              state: SolverState = None):
     """Solve PDD system at a specified voltage, with IFT for gradient
 
     Args:
         cell (PVCell): An initialized cell
         v (f64): Voltage to solve at, in dimensionless form
         pot_ini (Potentials): Initial guess of solution
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+        state (SolverState, optional): State shared with neighbouring solves, e.g. a reusable preconditioner. Defaults to None.
 
     Returns:
         (f64, Potentials): Tuple of current found, in dimensionless form, and solution
@@ -25,7 +34,7 @@ def solve_pdd(cell: PVCell, v: f64, pot_ini: Potentials):
     bound = bcond.boundary(cell, v)
 
     # Solve system
-    pot = solver.solve(cell, bound, pot_ini)
+    pot = solver.solve(cell, bound, pot_ini, opts, state)
 
     # Compute total current
     flux = current.total_current(cell, pot)
@@ -33,14 +42,72 @@ def solve_pdd(cell: PVCell, v: f64, pot_ini: Potentials):
     return flux, pot
 
 
+@partial(custom_vjp, nondiff_argnums=(3, 4))
+def solve_pdd_reverse(cell: PVCell,
+                      v: f64,
+                      pot_ini: Potentials,
+                      opts: SolverOptions = SolverOptions(),
+                      state: SolverState = None):
+    """Solve PDD system at a specified voltage, with a reverse-mode adjoint for gradient
+
+    The cotangent pass costs one transposed banded solve regardless of the number of design parameters.
+
+    Args:
+        cell (PVCell): An initialized cell
+        v (f64): Voltage to solve at, in dimensionless form
+        pot_ini (Potentials): Initial guess of solution
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+        state (SolverState, optional): State shared with neighbouring solves, e.g. a reusable preconditioner. Defaults to None.
+
+    Returns:
+        (f64, Potentials): Tuple of current found, in dimensionless form, and solution
+    """
+    return solve_pdd(cell, v, pot_ini, opts, state)
+
+
+def solve_pdd_reverse_fwd(cell, v, pot_ini, opts, state):
+
+    flux, pot = solve_pdd(cell, v, pot_ini, opts, state)
+
+    return (flux, pot), (cell, v, pot)
+
+
+def solve_pdd_reverse_bwd(opts, state, res, g):
+
+    cell, v, pot = res
+    gflux, gpot = g
+
+    # Cotangent of the solution, including its path through the current
+    _, current_vjp = vjp(current.total_current, cell, pot)
+    dcell_g, dpot_g = current_vjp(gflux)
+    gx = solver.pot2vec(dpot_g) + solver.pot2vec(gpot)
+
+    # Adjoint solve and pullback through the residual
+    spFx = residual.comp_F_deriv(cell, bcond.boundary(cell, v), pot)
+    lam = linalg.bandtsol(spFx, gx)
+    _, F_vjp = vjp(F_wb, cell, v, pot)
+    dcell_F, dv, _ = F_vjp(-lam)
+
+    dcell = tree_util.tree_map(jnp.add, dcell_g, dcell_F)
+
+    return dcell, dv, objects.zero_pot(pot.phi.size)
+
+
+solve_pdd_reverse.defvjp(solve_pdd_reverse_fwd, solve_pdd_reverse_bwd)
+
+
 @custom_jvp
-def solve_pdd_adjoint(cell: PVCell, v: f64, pot_ini: Potentials):
+def solve_pdd_adjoint(cell: PVCell,
+                      v: f64,
+                      pot_ini: Potentials,
+                      opts: SolverOptions = SolverOptions()):
     """Solve PDD system at a specified voltage, with adjoint method for gradient
 
     Args:
         cell (PVCell): An initialized cell
         v (f64): Voltage to solve at, in dimensionless form
         pot_ini (Potentials): Initial guess of solution
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
 
     Returns:
         (f64, Potentials): Tuple of current found, in dimensionless form, and solution
@@ -49,7 +116,7 @@ def solve_pdd_adjoint(cell: PVCell, v: f64, pot_ini: Potentials):
     bound = bcond.boundary(cell, v)
 
     # Solve system
-    pot = solver.solve(cell, bound, pot_ini)
+    pot = solver.solve(cell, bound, pot_ini, opts)
 
     # Compute total current
     flux = current.total_current(cell, pot)
@@ -84,12 +151,12 @@ def solve_pdd_adjoint_jvp(primals, tangents):
     Returns:
         Tuple: Value and tangent of PDD system solution
     """
-    cell, v, pot_ini = primals
-    dcell, _, _ = tangents
+    cell, v, pot_ini, opts = primals
+    dcell, _, _, _ = tangents
 
     # Solve forward problem
     bound = bcond.boundary(cell, v)
-    pot = solver.solve(cell, bound, pot_ini)
+    pot = solver.solve(cell, bound, pot_ini, opts)
     flux = current.total_current(cell, pot)
 
     # Compute gradients with adjoint method
@@ -103,9 +170,7 @@ def solve_pdd_adjoint_jvp(primals, tangents):
     gx = solver.pot2vec(gx_pot)  # vector form
 
     spFx = residual.comp_F_deriv(cell, bound, pot)
-    FxT = linalg.sparse2dense(spFx).T
-
-    lam = jnp.linalg.solve(FxT, gx)
+    lam = linalg.bandtsol(spFx, gx)
 
     dg = delg - jnp.dot(lam, delF)  # total derivative
 
@@ -1,5 +1,5 @@
 from deltapv import objects, physics, current, util
-from jax import numpy as jnp
+from jax import numpy as jnp, lax
 from typing import Tuple
 
 PVCell = objects.PVCell
@@ -7,20 +7,50 @@ Potentials = objects.Potentials
 Boundary = objects.Boundary
 Array = util.Array
 f64 = util.f64
+i64 = util.i64
+
+
+def last(cell: PVCell) -> i64:
+
+    return jnp.count_nonzero(cell.mask) - 1
+
+
+def tail(cell: PVCell, pot: Potentials = None) -> Tuple[PVCell, Potentials]:
+
+    # the last two nodes at the back contact, which for a padded cell are the
+    # last two unmasked nodes
+    if cell.mask is None:
+        return cell, pot
+
+    start = last(cell) - 1
+    cut = lambda x: lax.dynamic_slice(x, (start, ), (2, ))
+    params = {
+        key: cut(value) if jnp.ndim(value) == 1 else value
+        for key, value in cell.__dict__.items()
+    }
+    params["dgrid"] = lax.dynamic_slice(cell.dgrid, (start, ), (1, ))
+    params["mask"] = None
+    cellL = PVCell(**params)
+    potL = None if pot is None else Potentials(*map(cut, (pot.phi, pot.phi_n,
+                                                           pot.phi_p)))
+
+    return cellL, potL
 
 
 def boundary_phi(cell: PVCell) -> Tuple[f64, f64]:
 
+    cellL, _ = tail(cell)
+
     ohm0 = jnp.where(
         cell.Ndop[0] > 0,
         -cell.Chi[0] + jnp.log(jnp.abs(cell.Ndop[0] / cell.Nc[0])),
         -cell.Chi[0] - cell.Eg[0] - jnp.log(jnp.abs(-cell.Ndop[0] / cell.Nv[0])))
 
     ohmL = jnp.where(
-        cell.Ndop[-1] > 0,
-        -cell.Chi[-1] + jnp.log(jnp.abs(cell.Ndop[-1] / cell.Nc[-1])),
-        -cell.Chi[-1] - cell.Eg[-1] -
-        jnp.log(jnp.abs(-cell.Ndop[-1] / cell.Nv[-1])))
+        cellL.Ndop[-1] > 0,
+        -cellL.Chi[-1] + jnp.log(jnp.abs(cellL.Ndop[-1] / cellL.Nc[-1])),
+        -cellL.Chi[-1] - cellL.Eg[-1] -
+        jnp.log(jnp.abs(-cellL.Ndop[-1] / cellL.Nv[-1])))
     
     schott0 = -cell.PhiM0
     schottL = -cell.PhiML
@@ -41,10 +71,11 @@ def boundary_eq(cell: PVCell) -> Boundary:
 def boundary(cell: PVCell, v: f64) -> Boundary:
 
     phi0, phiLeq = boundary_phi(cell)
+    cellL, _ = tail(cell)
     neq0 = cell.Nc[0] * jnp.exp(cell.Chi[0] + phi0)
-    neqL = cell.Nc[-1] * jnp.exp(cell.Chi[-1] + phiLeq)
+    neqL = cellL.Nc[-1] * jnp.exp(cellL.Chi[-1] + phiLeq)
     peq0 = cell.Nv[0] * jnp.exp(-cell.Chi[0] - cell.Eg[0] - phi0)
-    peqL = cell.Nv[-1] * jnp.exp(-cell.Chi[-1] - cell.Eg[-1] - phiLeq)
+    peqL = cellL.Nv[-1] * jnp.exp(-cellL.Chi[-1] - cellL.Eg[-1] - phiLeq)
 
     return Boundary(phi0, phiLeq + v, neq0, neqL, peq0, peqL)
 
@@ -54,8 +85,11 @@ def contact_phin(cell: PVCell, bound: Boundary,
 
     n = physics.n(cell, pot)
     Jn = current.Jn(cell, pot)
-    return Jn[0] - cell.Snl * (n[0] - bound.neq0), Jn[-1] + cell.Snr * (
-        n[-1] - bound.neqL)
+    cellL, potL = tail(cell, pot)
+    nL = physics.n(cellL, potL)
+    JnL = current.Jn(cellL, potL)
+    return Jn[0] - cell.Snl * (n[0] - bound.neq0), JnL[-1] + cell.Snr * (
+        nL[-1] - bound.neqL)
 
 
 def contact_phin_deriv(cell: PVCell,
@@ -64,11 +98,15 @@ def contact_phin_deriv(cell: PVCell,
     n = physics.n(cell, pot)
     dJn_phin_maindiag, dJn_phin_upperdiag, dJn_phi_maindiag, dJn_phi_upperdiag = current.Jn_deriv(
         cell, pot)
+    cellL, potL = tail(cell, pot)
+    nL = physics.n(cellL, potL)
+    dJnL_phin_maindiag, dJnL_phin_upperdiag, dJnL_phi_maindiag, dJnL_phi_upperdiag = current.Jn_deriv(
+        cellL, potL)
 
     return dJn_phin_maindiag[0] - cell.Snl * n[0] , dJn_phin_upperdiag[0] , \
     dJn_phi_maindiag[0] - cell.Snl * n[0] , dJn_phi_upperdiag[0] , \
-    dJn_phin_maindiag[-1] , dJn_phin_upperdiag[-1] + cell.Snr * n[-1] , \
-    dJn_phi_maindiag[-1] , dJn_phi_upperdiag[-1] + cell.Snr * n[-1]
+    dJnL_phin_maindiag[-1] , dJnL_phin_upperdiag[-1] + cell.Snr * nL[-1] , \
+    dJnL_phi_maindiag[-1] , dJnL_phi_upperdiag[-1] + cell.Snr * nL[-1]
 
 
 def contact_phip(cell: PVCell, bound: Boundary,
@@ -76,8 +114,11 @@ def contact_phip(cell: PVCell, bound: Boundary,
 
     p = physics.p(cell, pot)
     Jp = current.Jp(cell, pot)
-    return Jp[0] + cell.Spl * (p[0] - bound.peq0), Jp[-1] - cell.Spr * (
-        p[-1] - bound.peqL)
+    cellL, potL = tail(cell, pot)
+    pL = physics.p(cellL, potL)
+    JpL = current.Jp(cellL, potL)
+    return Jp[0] + cell.Spl * (p[0] - bound.peq0), JpL[-1] - cell.Spr * (
+        pL[-1] - bound.peqL)
 
 
 def contact_phip_deriv(cell: PVCell,
@@ -86,14 +127,19 @@ def contact_phip_deriv(cell: PVCell,
     p = physics.p(cell, pot)
     dJp_phip_maindiag, dJp_phip_upperdiag, dJp_phi_maindiag, dJp_phi_upperdiag = current.Jp_deriv(
         cell, pot)
+    cellL, potL = tail(cell, pot)
+    pL = physics.p(cellL, potL)
+    dJpL_phip_maindiag, dJpL_phip_upperdiag, dJpL_phi_maindiag, dJpL_phi_upperdiag = current.Jp_deriv(
+        cellL, potL)
 
     return dJp_phip_maindiag[0] - cell.Spl * p[0] , dJp_phip_upperdiag[0] , \
     dJp_phi_maindiag[0] - cell.Spl * p[0] , dJp_phi_upperdiag[0] , \
-    dJp_phip_maindiag[-1] , dJp_phip_upperdiag[-1] + cell.Spr * p[-1] , \
-    dJp_phi_maindiag[-1] , dJp_phi_upperdiag[-1] + cell.Spr * p[-1]
+    dJpL_phip_maindiag[-1] , dJpL_phip_upperdiag[-1] + cell.Spr * pL[-1] , \
+    dJpL_phi_maindiag[-1] , dJpL_phi_upperdiag[-1] + cell.Spr * pL[-1]
 
 
 def contact_phi(cell: PVCell, bound: Boundary,
                 pot: Potentials) -> Tuple[f64, f64]:
 
-    return pot.phi[0] - bound.phi0, pot.phi[-1] - bound.phiL
+    _, potL = tail(cell, pot)
+    return pot.phi[0] - bound.phi0, potL.phi[-1] - bound.phiL
@@ -170,7 +170,10 @@ def Jp_deriv(cell: PVCell, pot: Potentials) -> Tuple[Array, Array, Array, Array]
 def total_current(cell: PVCell, pot: Potentials) -> f64:
 
     Jtotal = Jn(cell, pot) + Jp(cell, pot)
-    curr = jnp.mean(Jtotal)
+    if cell.mask is None:
+        curr = jnp.mean(Jtotal)
+    else:
+        curr = jnp.sum(Jtotal * cell.mask[1:]) / jnp.sum(cell.mask[1:])
 
     return curr
 
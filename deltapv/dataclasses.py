@@ -31,8 +31,8 @@ def dataclass(clz):
     return data_clz
 
 
-def static_field():
-    return dataclasses.field(metadata={'static': True})
+def static_field(default=dataclasses.MISSING):
+    return dataclasses.field(default=default, metadata={'static': True})
 
 
 replace = dataclasses.replace
@@ -1,13 +1,15 @@
 from deltapv import util
-from jax import numpy as jnp, ops, vmap, lax, jit
+from jax import numpy as jnp, ops, vmap, lax, jit, linearize
 from jax.scipy.sparse.linalg import gmres
-from functools import partial
-from typing import Callable
+from jax.scipy.linalg import solve_triangular
+from functools import partial, lru_cache
+from typing import Callable, Tuple, Sequence
 
 Array = util.Array
 f64 = util.f64
 i64 = util.i64
 _W = 13
+_B = 3  # unknowns per node, ordered (phi_n, phi_p, phi)
 
 
 @partial(jit, static_argnums=(3, ))
@@ -18,6 +20,36 @@ def coo2sparse(row: Array, col: Array, data: Array, n: i64) -> Array:
     return sparse
 
 
+@lru_cache(maxsize=None)
+def bandplan(layout: Tuple[Tuple[int, int, Tuple[int, int]], ...],
+             nodes: int, block: int) -> Tuple[Tuple[Tuple[int, int, int], ...],
+                                              ...]:
+    # Each layout entry (component, column offset, (first, stop) node range)
+    # describes a derivative vector that lies on one diagonal of the band.
+    # The plan lists, for every band column, which vectors fill it and how
+    # much zero padding puts them in place.
+    plan = [[] for _ in range(block * _W)]
+    for idx, (comp, offset, (first, stop)) in enumerate(layout):
+        nrange = range(nodes)[first:stop]
+        plan[comp * _W + offset + _W // 2].append(
+            (idx, nrange.start, nodes - nrange.stop))
+
+    return tuple(tuple(entries) for entries in plan)
+
+
+def plan2sparse(plan: Tuple[Tuple[Tuple[int, int, int], ...], ...],
+                values: Sequence[Array], nodes: int) -> Array:
+
+    cols = [
+        sum((jnp.pad(jnp.reshape(values[idx], -1), (before, after))
+             for idx, before, after in entries), jnp.zeros(nodes))
+        for entries in plan
+    ]
+    sparse = jnp.stack(cols, axis=1).reshape(-1, _W)
+
+    return sparse
+
+
 @jit
 def sparse2dense(m: Array) -> Array:
 
@@ -34,11 +66,25 @@ def sparse2dense(m: Array) -> Array:
 
 @jit
 def spmatvec(m: Array, x: Array) -> Array:
-    def _onerow(m, x, i):
-        return jnp.dot(m[i], lax.dynamic_slice(x, [i], [_W]))
+    # Sum of _W shifted diagonals; x may carry extra trailing dimensions
+    n = m.shape[0]
+    tail = (1, ) * (x.ndim - 1)
+    xpad = jnp.pad(x, [(_W // 2, _W // 2)] + [(0, 0)] * (x.ndim - 1))
 
-    return vmap(_onerow, (None, None, 0))(m, jnp.pad(x, pad_width=_W // 2),
-                                          jnp.arange(x.size))
+    return sum(m[:, d].reshape((n, ) + tail) * xpad[d:d + n]
+               for d in range(_W))
+
+
+@jit
+def sptmatvec(m: Array, x: Array) -> Array:
+    # Product with the transpose, shifting each diagonal by its offset
+    n = m.shape[0]
+    tail = (1, ) * (x.ndim - 1)
+    pad = [(_W // 2, _W // 2)] + [(0, 0)] * (x.ndim - 1)
+
+    return sum(
+        jnp.pad(m[:, d].reshape((n, ) + tail) * x, pad)[_W - 1 - d:][:n]
+        for d in range(_W))
 
 
 @jit
@@ -57,6 +103,7 @@ def spwrite(m: Array, i: i64, j: i64, value: f64) -> Array:
 
 
 @jit
+@util.counted
 def spilu(m: Array) -> Array:
 
     n = m.shape[0]
@@ -125,6 +172,7 @@ def bsub(m: Array, b: Array) -> Array:
 
 
 @jit
+@util.counted
 def linsol(spmat: Array, vec: Array, tol=1e-12) -> Array:
 
     mvp = partial(spmatvec, spmat)
@@ -142,6 +190,386 @@ def linsol(spmat: Array, vec: Array, tol=1e-12) -> Array:
     return sol
 
 
+@jit
+def sparse2block(m: Array) -> Tuple[Array, Array, Array]:
+    # Split into sub-, main and super-diagonal blocks of size _B x _B
+    nb = m.shape[0] // _B
+    mb = m.reshape(nb, _B, _W)
+    a = jnp.arange(_B).reshape(-1, 1)
+    disp = jnp.arange(_B).reshape(1, -1) - a + _W // 2
+
+    lower = mb[:, a, disp - _B]
+    diag = mb[:, a, disp]
+    upper = mb[:, a, disp + _B]
+
+    return lower, diag, upper
+
+
+@jit
+def btfactor(m: Array) -> Tuple[Array, Array, Array]:
+    # Block Thomas elimination, keeping the Schur complements s and the
+    # eliminated super-diagonal blocks g = s^-1 upper
+    lower, diag, upper = sparse2block(m)
+
+    def forward(gprev, blocks):
+        low, dia, upp = blocks
+        s = dia - low @ gprev
+        g = jnp.linalg.solve(s, upp)
+        return g, (s, g)
+
+    _, (s, g) = lax.scan(forward, jnp.zeros((_B, _B)), (lower, diag, upper))
+
+    return lower, s, g
+
+
+@jit
+def btsolve(fact: Tuple[Array, Array, Array], vec: Array) -> Array:
+
+    lower, s, g = fact
+    b = vec.reshape(s.shape[0], _B, -1)
+
+    def forward(yprev, blocks):
+        low, si, bi = blocks
+        y = jnp.linalg.solve(si, bi - low @ yprev)
+        return y, y
+
+    def backward(xnext, blocks):
+        gi, yi = blocks
+        x = yi - gi @ xnext
+        return x, x
+
+    _, y = lax.scan(forward, jnp.zeros_like(b[0]), (lower, s, b))
+    _, x = lax.scan(backward, jnp.zeros_like(b[0]), (g, y), reverse=True)
+
+    return x.reshape(vec.shape)
+
+
+@jit
+@util.counted
+def btsol(spmat: Array, vec: Array) -> Array:
+
+    return btsolve(btfactor(spmat), vec)
+
+
+@jit
+@util.counted
+def pcrsol(spmat: Array, vec: Array) -> Array:
+    # Block parallel cyclic reduction: each level eliminates the couplings at
+    # distance s from every row at once, so the depth is ceil(log2(nb))
+    lower, diag, upper = sparse2block(spmat)
+    nb = diag.shape[0]
+    d = vec.reshape(nb, _B, -1)
+    eye = jnp.broadcast_to(jnp.eye(_B, dtype=diag.dtype), diag.shape)
+
+    def before(x, s, fill):
+        return jnp.concatenate([fill[:s], x[:-s]])
+
+    def after(x, s, fill):
+        return jnp.concatenate([x[s:], fill[:s]])
+
+    s = 1
+    while s < nb:
+        zeros, zerod = jnp.zeros_like(lower), jnp.zeros_like(d)
+        alpha = -jnp.linalg.solve(
+            jnp.swapaxes(before(diag, s, eye), 1, 2),
+            jnp.swapaxes(lower, 1, 2)).swapaxes(1, 2)
+        gamma = -jnp.linalg.solve(
+            jnp.swapaxes(after(diag, s, eye), 1, 2),
+            jnp.swapaxes(upper, 1, 2)).swapaxes(1, 2)
+        diag = diag + alpha @ before(upper, s, zeros) + gamma @ after(
+            lower, s, zeros)
+        d = d + alpha @ before(d, s, zerod) + gamma @ after(d, s, zerod)
+        lower = alpha @ before(lower, s, zeros)
+        upper = gamma @ after(upper, s, zeros)
+        s *= 2
+
+    return jnp.linalg.solve(diag, d).reshape(vec.shape)
+
+
+@jit
+@util.counted
+def bandlu(m: Array) -> Tuple[Array, Array, Array]:
+    # Banded LU with partial pivoting. With kl = ku = _W // 2 the fill-in of
+    # U reaches 2 * (_W // 2) above the diagonal, so row k of u holds columns
+    # k, ..., k + _W - 1. The active window holds rows k, ..., k + _W // 2
+    # and columns k, ..., k + _W - 1 of the partially eliminated matrix.
+    n = m.shape[0]
+    h = _W // 2
+    rows = jnp.arange(h + 1).reshape(-1, 1)
+    disp = jnp.arange(_W).reshape(1, -1) - rows + h
+    valid = (disp >= 0) & (disp < _W) & (rows < n)
+    mpad = jnp.pad(m, ((0, _W), (0, 0)))
+    window = jnp.where(valid, mpad[rows, jnp.clip(disp, 0, _W - 1)], 0)
+
+    def eliminate(window, newrow):
+        piv = jnp.argmax(jnp.abs(window[:, 0]))
+        top = window[piv]
+        window = window.at[piv].set(window[0]).at[0].set(top)
+        mult = window[1:, 0] / top[0]
+        rest = window[1:] - mult.reshape(-1, 1) * top
+        window = jnp.concatenate(
+            [jnp.pad(rest[:, 1:], ((0, 0), (0, 1))),
+             newrow.reshape(1, -1)])
+        return window, (top, mult, piv)
+
+    _, (u, l, piv) = lax.scan(eliminate, window, mpad[h + 1:n + h + 1])
+
+    return u, l, piv
+
+
+@jit
+def lusolve(fact: Tuple[Array, Array, Array], b: Array) -> Array:
+
+    u, l, piv = fact
+    n = u.shape[0]
+    h = _W // 2
+    bpad = jnp.pad(b, [(0, _W)] + [(0, 0)] * (b.ndim - 1))
+
+    def forward(window, blocks):
+        lk, pk, newentry = blocks
+        top = window[pk]
+        window = window.at[pk].set(window[0]).at[0].set(top)
+        rest = window[1:] - jnp.tensordot(lk, top, 0)
+        window = jnp.concatenate([rest, newentry[None]])
+        return window, top
+
+    _, y = lax.scan(forward, bpad[:h + 1], (l, piv, bpad[h + 1:n + h + 1]))
+
+    def backward(window, blocks):
+        uk, yk = blocks
+        xk = (yk - jnp.tensordot(uk[1:], window, 1)) / uk[0]
+        window = jnp.concatenate([xk[None], window[:-1]])
+        return window, xk
+
+    _, x = lax.scan(backward, jnp.zeros_like(bpad[:_W - 1]), (u, y),
+                    reverse=True)
+
+    return x
+
+
+@jit
+def lutsolve(fact: Tuple[Array, Array, Array], b: Array) -> Array:
+
+    u, l, piv = fact
+    n = u.shape[0]
+    h = _W // 2
+    ut = jnp.stack(
+        [jnp.pad(u[:, j], (j, 0))[:n] for j in range(1, _W)], axis=1)
+
+    def forward(window, blocks):
+        utk, ukk, bk = blocks
+        zk = (bk - jnp.tensordot(utk, window, 1)) / ukk
+        window = jnp.concatenate([zk[None], window[:-1]])
+        return window, zk
+
+    _, z = lax.scan(forward, jnp.zeros((_W - 1, ) + b.shape[1:]),
+                    (ut, u[:, 0], b))
+
+    def backward(window, blocks):
+        lk, pk, zk = blocks
+        window = jnp.concatenate([zk[None], window[:-1]])
+        window = window.at[0].add(-jnp.tensordot(lk, window[1:], 1))
+        top = window[pk]
+        window = window.at[pk].set(window[0]).at[0].set(top)
+        return window, window[-1]
+
+    window, x = lax.scan(backward,
+                         jnp.zeros((h + 1, ) + b.shape[1:]), (l, piv, z),
+                         reverse=True)
+    x = jnp.concatenate([window[:-1], x])[:n]
+
+    return x
+
+
+@jit
+def bandsol(spmat: Array, vec: Array) -> Array:
+
+    fact = bandlu(spmat)
+
+    return lax.custom_linear_solve(
+        partial(spmatvec, spmat),
+        vec,
+        solve=lambda _, b: lusolve(fact, b),
+        transpose_solve=lambda _, b: lutsolve(fact, b))
+
+
+@jit
+def bandtsol(spmat: Array, vec: Array) -> Array:
+
+    fact = bandlu(spmat)
+
+    return lax.custom_linear_solve(
+        partial(sptmatvec, spmat),
+        vec,
+        solve=lambda _, b: lutsolve(fact, b),
+        transpose_solve=lambda _, b: lusolve(fact, b))
+
+
+def thomas(a: Array, b: Array, c: Array, d: Array) -> Array:
+
+    # a, b, c are the sub-, main and superdiagonal, a[0] and c[-1] unused
+    def fwd(carry, row):
+        cp, dp = carry
+        ai, bi, ci, di = row
+        denom = bi - ai * cp
+        cn, dn = ci / denom, (di - ai * dp) / denom
+        return (cn, dn), (cn, dn)
+
+    def bwd(x, row):
+        cp, dp = row
+        xi = dp - cp * x
+        return xi, xi
+
+    zero = jnp.zeros((), dtype=d.dtype)
+    _, (cps, dps) = lax.scan(fwd, (zero, zero), (a, b, c, d))
+    _, x = lax.scan(bwd, zero, (cps, dps), reverse=True)
+
+    return x
+
+
+@jit
+def trisol(spmat: Array, vec: Array) -> Array:
+
+    a, b, c = spmat[:, _W // 2 - 1], spmat[:, _W // 2], spmat[:, _W // 2 + 1]
+    at = jnp.roll(c, 1)
+    ct = jnp.roll(a, -1)
+
+    return lax.custom_linear_solve(
+        partial(spmatvec, spmat),
+        vec,
+        solve=lambda _, r: thomas(a, b, c, r),
+        transpose_solve=lambda _, r: thomas(at, b, ct, r))
+
+
+@jit
+def tritsol(spmat: Array, vec: Array) -> Array:
+
+    a, b, c = spmat[:, _W // 2 - 1], spmat[:, _W // 2], spmat[:, _W // 2 + 1]
+    at = jnp.roll(c, 1)
+    ct = jnp.roll(a, -1)
+
+    return lax.custom_linear_solve(
+        partial(sptmatvec, spmat),
+        vec,
+        solve=lambda _, r: thomas(at, b, ct, r),
+        transpose_solve=lambda _, r: thomas(a, b, c, r))
+
+
+def spsolve(spmat: Array,
+            vec: Array,
+            method: str = "gmres",
+            tol: f64 = 1e-12) -> Array:
+
+    if method == "gmres":
+        return linsol(spmat, vec, tol=tol)
+    if method == "block":
+        return btsol(spmat, vec)
+    if method == "pcr":
+        return pcrsol(spmat, vec)
+    if method == "lu":
+        return bandsol(spmat, vec)
+    raise ValueError(f"Unknown linear solver {method}")
+
+
+def pgmres(matvec: Callable[[Array], Array],
+           b: Array,
+           precond: Callable[[Array], Array],
+           tol: f64 = 1e-6,
+           restart: i64 = 20,
+           maxiter: i64 = 10) -> Tuple[Array, i64, f64]:
+    # Right-preconditioned restarted GMRES which, unlike jax's gmres, also
+    # returns the number of Krylov iterations and the relative residual
+    n = b.size
+    bnorm = jnp.linalg.norm(b)
+    target = tol * bnorm
+
+    def arnoldi(carry):
+        j, V, R, cs, sn, g = carry
+        w = matvec(precond(V[j]))
+        mask = jnp.arange(restart + 1) <= j
+        h = jnp.zeros(restart + 1)
+        for _ in range(2):  # classical Gram-Schmidt with reorthogonalization
+            dh = jnp.where(mask, V @ w, 0)
+            w = w - dh @ V
+            h = h + dh
+        hn = jnp.linalg.norm(w)
+        V = V.at[j + 1].set(w / jnp.where(hn > 0, hn, 1))
+        h = h.at[j + 1].set(hn)
+
+        def rotate(i, h):
+            hi = cs[i] * h[i] + sn[i] * h[i + 1]
+            hi1 = -sn[i] * h[i] + cs[i] * h[i + 1]
+            return h.at[i].set(hi).at[i + 1].set(hi1)
+
+        h = lax.fori_loop(0, j, rotate, h)
+        denom = jnp.sqrt(h[j]**2 + hn**2)
+        c, s = h[j] / denom, hn / denom
+        h = h.at[j].set(denom)
+        g = g.at[j + 1].set(-s * g[j]).at[j].set(c * g[j])
+        R = R.at[:, j].set(h[:restart])
+
+        return j + 1, V, R, cs.at[j].set(c), sn.at[j].set(s), g
+
+    def arnoldi_cond(carry):
+        j, _, _, _, _, g = carry
+        return jnp.logical_and(j < restart, jnp.abs(g[j]) > target)
+
+    def cycle(carry):
+        x, k, niter, _ = carry
+        r = b - matvec(x)
+        beta = jnp.linalg.norm(r)
+        V = jnp.zeros((restart + 1, n)).at[0].set(
+            r / jnp.where(beta > 0, beta, 1))
+        g = jnp.zeros(restart + 1).at[0].set(beta)
+        ini = (0, V, jnp.zeros((restart, restart)), jnp.zeros(restart),
+               jnp.zeros(restart), g)
+        j, V, R, _, _, g = lax.while_loop(arnoldi_cond, arnoldi, ini)
+        unused = jnp.arange(restart) >= j
+        R = R + jnp.diag(unused.astype(R.dtype))
+        y = solve_triangular(R, jnp.where(unused, 0, g[:restart]), lower=False)
+        x = x + precond(y @ V[:restart])
+        return x, k + 1, niter + j, jnp.abs(g[j])
+
+    def cycle_cond(carry):
+        _, k, _, res = carry
+        return jnp.logical_and(k < maxiter, res > target)
+
+    x, _, niter, res = lax.while_loop(cycle_cond, cycle,
+                                      (jnp.zeros_like(b), 0, 0, bnorm))
+    relres = res / jnp.where(bnorm > 0, bnorm, 1)
+
+    return x, niter, relres
+
+
+def jacband(fun: Callable[[Array], Array], x: Array, block: i64 = _B) -> Array:
+
+    # Band Jacobian of a block-tridiagonal map from 3 * block colored jvps:
+    # columns whose indices agree modulo 3 * block never share a row
+    n = x.size
+    ncol = 3 * block
+    seeds = (jnp.arange(n) % ncol == jnp.arange(ncol).reshape(-1, 1)).astype(
+        x.dtype)
+    _, mvp = linearize(fun, x)
+    compressed = vmap(mvp)(seeds)
+    rows = jnp.arange(n).reshape(-1, 1)
+    cols = rows + jnp.arange(_W) - _W // 2
+    valid = (cols >= 0) & (cols < n) & (jnp.abs(cols // block - rows // block)
+                                        <= 1)
+    band = compressed[cols % ncol, rows]
+
+    return jnp.where(valid, band, 0)
+
+
+def ilusol(mvp: Callable[[Array], Array], vec: Array, fact: Array,
+           tol=1e-12) -> Tuple[Array, i64, f64]:
+
+    # GMRES preconditioned by an ILU factorization, possibly of an older
+    # matrix than the one mvp multiplies by
+    precond = lambda b: bsub(fact, fsub(fact, b))
+
+    return pgmres(mvp, vec, precond, tol=tol)
+
+
 @jit
 def transpose(m: Array) -> Array:
 
@@ -33,6 +33,7 @@ class PVDesign:
     Spr: f64
     PhiM0: f64
     PhiML: f64
+    mask: Array = None
 
 
 @dataclasses.dataclass
@@ -60,6 +61,7 @@ class PVCell:
     Spr: f64
     PhiM0: f64
     PhiML: f64
+    mask: Array = None
 
 
 def zero_cell(n: i64) -> PVCell:
@@ -122,6 +124,17 @@ class Boundary:
     peqL: f64
 
 
+@dataclasses.dataclass
+class SolverOptions:
+    linsolver: str = dataclasses.static_field("gmres")
+    compiled: bool = dataclasses.static_field(False)
+    reuse_precond: bool = dataclasses.static_field(False)
+    refactor_iters: int = dataclasses.static_field(10)
+    forcing: str = dataclasses.static_field("fixed")
+    globalization: str = dataclasses.static_field("momentum")
+    reverse: bool = dataclasses.static_field(False)
+
+
 def update(obj: Union[PVDesign, PVCell, Material], **kwargs) -> Union[PVDesign, PVCell, Material]:
 
     return obj.__class__(
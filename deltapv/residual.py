@@ -1,5 +1,5 @@
 from deltapv import objects, ddiff, bcond, poisson, linalg, util
-from jax import numpy as jnp, ops, jit, jacfwd
+from jax import numpy as jnp, ops, jit, jacfwd, lax
 
 PVCell = objects.PVCell
 Potentials = objects.Potentials
@@ -7,8 +7,56 @@ Boundary = objects.Boundary
 Array = util.Array
 f64 = util.f64
 
+# (component, column offset, node range) of every vector of comp_F_deriv, in
+# the order they are computed; rows and columns are ordered (phi_n, phi_p, phi)
+# per node
+_FIRST, _INTERIOR, _LAST = (0, 1), (1, -1), (-1, None)
+DERIV_LAYOUT = (
+    (0, 0, _FIRST), (0, 2, _FIRST), (0, 3, _FIRST), (0, 5, _FIRST),
+    (1, 0, _FIRST), (1, 1, _FIRST), (1, 3, _FIRST), (1, 4, _FIRST),
+    (2, 0, _FIRST),
+    (0, -3, _LAST), (0, -1, _LAST), (0, 0, _LAST), (0, 2, _LAST),
+    (1, -3, _LAST), (1, -2, _LAST), (1, 0, _LAST), (1, 1, _LAST),
+    (2, 0, _LAST),
+    (0, -3, _INTERIOR), (0, 0, _INTERIOR), (0, 3, _INTERIOR),
+    (0, 1, _INTERIOR), (0, -1, _INTERIOR), (0, 2, _INTERIOR),
+    (0, 5, _INTERIOR),
+    (1, -1, _INTERIOR), (1, -3, _INTERIOR), (1, 0, _INTERIOR),
+    (1, 3, _INTERIOR), (1, -2, _INTERIOR), (1, 1, _INTERIOR),
+    (1, 4, _INTERIOR),
+    (2, -3, _INTERIOR), (2, 0, _INTERIOR), (2, 3, _INTERIOR),
+    (2, -2, _INTERIOR), (2, -1, _INTERIOR),
+)
+EQ_DERIV_LAYOUT = (
+    (0, 0, _FIRST),
+    (0, -1, _INTERIOR), (0, 0, _INTERIOR), (0, 1, _INTERIOR),
+    (0, 0, _LAST),
+)
+
+
+def pad_F(cell: PVCell, F: Array, x: Array, k: int) -> Array:
+
+    # On a padded cell, the back contact equations (the last k entries) move to
+    # the last unmasked node and every masked node follows its left neighbour,
+    # which leaves the unmasked solution untouched
+    F = lax.dynamic_update_slice(F, F[-k:], (k * bcond.last(cell), ))
+    inert = jnp.repeat(cell.mask == 0, k)
+
+    return jnp.where(inert, x - jnp.roll(x, k), F)
+
+
+def pad_F_deriv(cell: PVCell, spF: Array, k: int) -> Array:
+
+    spF = lax.dynamic_update_slice(spF, spF[-k:], (k * bcond.last(cell), 0))
+    follow = jnp.zeros(linalg._W).at[linalg._W // 2].set(1.).at[
+        linalg._W // 2 - k].set(-1.)
+    inert = jnp.repeat(cell.mask == 0, k)
+
+    return jnp.where(inert.reshape(-1, 1), follow, spF)
+
 
 @jit
+@util.counted
 def comp_F(cell: PVCell, bound: Boundary, pot: Potentials) -> Array:
 
     ddn = ddiff.ddn(cell, pot)
@@ -27,10 +75,15 @@ def comp_F(cell: PVCell, bound: Boundary, pot: Potentials) -> Array:
     result = result.at[5:lenF - 3:3].set(pois)
     result = result.at[-3:].set(jnp.array([ctct_L_phin, ctct_L_phip, ctct_L_phi]))
 
+    if cell.mask is not None:
+        x = jnp.stack([pot.phi_n, pot.phi_p, pot.phi], axis=1).ravel()
+        result = pad_F(cell, result, x, 3)
+
     return result
 
 
 @jit
+@util.counted
 def comp_F_deriv(cell: PVCell, bound: Boundary, pot: Potentials) -> Array:
 
     dde_phin_, dde_phin__, dde_phin___, dde_phip__, dde_phi_, dde_phi__, dde_phi___ = ddiff.ddn_deriv(
@@ -44,82 +97,31 @@ def comp_F_deriv(cell: PVCell, bound: Boundary, pot: Potentials) -> Array:
 
     N = cell.Eg.size
 
-    row = jnp.concatenate([
-        jnp.zeros(4),
-        jnp.ones(4),
-        jnp.array([2]),
-        jnp.tile(3 * (N - 1), 4),
-        jnp.tile(3 * (N - 1) + 1, 4),
-        jnp.array([3 * (N - 1) + 2]),
-        jnp.tile(jnp.arange(3, 3 * (N - 1), 3), 7),
-        jnp.tile(jnp.arange(4, 3 * (N - 1) + 1, 3), 7),
-        jnp.tile(jnp.arange(5, 3 * (N - 1) + 2, 3), 5)
-    ]).astype(jnp.int32)
-
-    col = jnp.concatenate([
-        jnp.array([0, 2, 3, 5]),
-        jnp.array([1, 2, 4, 5]),
-        jnp.array([2]),
-        jnp.array([3 * (N - 2), 3 * (N - 2) + 2, 3 * (N - 1), 3 * (N - 1) + 2]),
-        jnp.array([
-            3 * (N - 2) + 1, 3 * (N - 2) + 2, 3 * (N - 1) + 1, 3 * (N - 1) + 2
-        ]),
-        jnp.array([3 * (N - 1) + 2]),
-        jnp.arange(0, 3 * (N - 2), 3),
-        jnp.arange(3, 3 * (N - 1), 3),
-        jnp.arange(6, 3 * N, 3),
-        jnp.arange(4, 3 * (N - 1) + 1, 3),
-        jnp.arange(2, 3 * (N - 2) + 2, 3),
-        jnp.arange(5, 3 * (N - 1) + 2, 3),
-        jnp.arange(8, 3 * N + 2, 3),
-        jnp.arange(3, 3 * (N - 1), 3),
-        jnp.arange(1, 3 * (N - 2) + 1, 3),
-        jnp.arange(4, 3 * (N - 1) + 1, 3),
-        jnp.arange(7, 3 * N + 1, 3),
-        jnp.arange(2, 3 * (N - 2) + 2, 3),
-        jnp.arange(5, 3 * (N - 1) + 2, 3),
-        jnp.arange(8, 3 * N + 2, 3),
-        jnp.arange(2, 3 * (N - 2) + 2, 3),
-        jnp.arange(5, 3 * (N - 1) + 2, 3),
-        jnp.arange(8, 3 * N + 2, 3),
-        jnp.arange(3, 3 * (N - 1), 3),
-        jnp.arange(4, 3 * (N - 1) + 1, 3)
-    ]).astype(jnp.int32)
-
-    dF = jnp.concatenate([
-        jnp.array([dctct_phin[0], dctct_phin[2], dctct_phin[1], dctct_phin[3]]),
-        jnp.array([dctct_phip[0], dctct_phip[2], dctct_phip[1], dctct_phip[3]]),
-        jnp.ones(1),
-        jnp.array([dctct_phin[4], dctct_phin[6], dctct_phin[5], dctct_phin[7]]),
-        jnp.array([dctct_phip[4], dctct_phip[6], dctct_phip[5], dctct_phip[7]]),
-        jnp.ones(1),
-        dde_phin_,
-        dde_phin__,
-        dde_phin___,
-        dde_phip__,
-        dde_phi_,
-        dde_phi__,
-        dde_phi___,
-        ddp_phin__,
-        ddp_phip_,
-        ddp_phip__,
-        ddp_phip___,
-        ddp_phi_,
-        ddp_phi__,
-        ddp_phi___,
-        dpois_phi_,
-        dpois_phi__,
-        dpois_phi___,
-        dpois_dphin__,
-        dpois_dphip__,
-    ])
-
-    spF = linalg.coo2sparse(row, col, dF, 3 * N)
+    dF = [
+        dctct_phin[0], dctct_phin[2], dctct_phin[1], dctct_phin[3],
+        dctct_phip[0], dctct_phip[2], dctct_phip[1], dctct_phip[3],
+        1.,
+        dctct_phin[4], dctct_phin[6], dctct_phin[5], dctct_phin[7],
+        dctct_phip[4], dctct_phip[6], dctct_phip[5], dctct_phip[7],
+        1.,
+        dde_phin_, dde_phin__, dde_phin___, dde_phip__,
+        dde_phi_, dde_phi__, dde_phi___,
+        ddp_phin__, ddp_phip_, ddp_phip__, ddp_phip___,
+        ddp_phi_, ddp_phi__, ddp_phi___,
+        dpois_phi_, dpois_phi__, dpois_phi___, dpois_dphin__, dpois_dphip__,
+    ]
+
+    plan = linalg.bandplan(DERIV_LAYOUT, N, 3)
+    spF = linalg.plan2sparse(plan, dF, N)
+
+    if cell.mask is not None:
+        spF = pad_F_deriv(cell, spF, 3)
 
     return spF
 
 
 @jit
+@util.counted
 def comp_F_eq(cell: PVCell, bound: Boundary, pot: Potentials) -> Array:
 
     pois = poisson.pois(cell, pot)
@@ -128,35 +130,25 @@ def comp_F_eq(cell: PVCell, bound: Boundary, pot: Potentials) -> Array:
         [jnp.array([ctct_0_phi]), pois,
          jnp.array([ctct_L_phi])])
 
+    if cell.mask is not None:
+        resid = pad_F(cell, resid, pot.phi, 1)
+
     return resid
 
 
 @jit
+@util.counted
 def comp_F_eq_deriv(cell: PVCell, bound: Boundary, pot: Potentials) -> Array:
 
     N = cell.Eg.size
     dpois_phi_, dpois_phi__, dpois_phi___ = poisson.pois_deriv_eq(cell, pot)
 
-    row = jnp.concatenate([
-        jnp.array([0]),
-        jnp.arange(1, N - 1),
-        jnp.arange(1, N - 1),
-        jnp.arange(1, N - 1),
-        jnp.array([N - 1])
-    ]).astype(jnp.int32)
-
-    col = jnp.concatenate([
-        jnp.array([0]),
-        jnp.arange(0, N - 2),
-        jnp.arange(1, N - 1),
-        jnp.arange(2, N),
-        jnp.array([N - 1])
-    ]).astype(jnp.int32)
-
-    dFeq = jnp.concatenate(
-        [jnp.array([1]), dpois_phi_, dpois_phi__, dpois_phi___,
-         jnp.array([1])])
-
-    spFeq = linalg.coo2sparse(row, col, dFeq, N)
+    dFeq = [1., dpois_phi_, dpois_phi__, dpois_phi___, 1.]
+
+    plan = linalg.bandplan(EQ_DERIV_LAYOUT, N, 1)
+    spFeq = linalg.plan2sparse(plan, dFeq, N)
+
+    if cell.mask is not None:
+        spFeq = pad_F_deriv(cell, spFeq, 1)
 
     return spFeq
@@ -1,6 +1,10 @@
-from deltapv import objects, scales, optical, sun, materials, solver, bcond, current, spline, util, adjoint, plotting
-from jax import numpy as jnp, ops, lax, vmap
-from typing import Callable, Tuple, List, Union
+from deltapv import objects, scales, optical, sun, materials, solver, bcond, current, spline, util, adjoint, residual, linalg, plotting
+from jax import numpy as jnp, ops, lax, vmap, jit, jvp, vjp, linearize, value_and_grad, tree_util, core
+from typing import Callable, Iterator, Tuple, List, Union
+from functools import partial
+import numpy as np
+import collections
+import hashlib
 import matplotlib.pyplot as plt
 import logging
 logger = logging.getLogger("deltapv")
@@ -10,10 +14,13 @@ PVDesign = objects.PVDesign
 Material = objects.Material
 LightSource = objects.LightSource
 Potentials = objects.Potentials
+SolverOptions = objects.SolverOptions
 Array = util.Array
 f64 = util.f64
 i64 = util.i64
 DIM_V_INIT = 0.01
+CELL_CACHE_SIZE = 16
+_cells = collections.OrderedDict()
 
 
 def empty_design(dim_grid: Array) -> PVDesign:
@@ -163,6 +170,50 @@ def make_design(n_points: i64,
     return des
 
 
+def pad_design(design: PVDesign, n_points: i64 = None) -> PVDesign:
+    """Pad a design with inert nodes behind the back contact, so that designs of similar size share compiled kernels
+
+    The padded nodes copy the last material and are masked out of the residual, leaving the solution on the original nodes unchanged. Use util.compiles to inspect how often the solver kernels were compiled.
+
+    Args:
+        design (PVDesign): A design, possibly padded already
+        n_points (i64, optional): Number of nodes after padding. Defaults to the smallest canonical size given by util.bucket.
+
+    Returns:
+        PVDesign: Padded design with a mask of its original nodes
+    """
+    n = design.grid.size
+    mask = jnp.ones(n) if design.mask is None else design.mask
+    size = int(jnp.count_nonzero(mask))
+    if n_points is None:
+        n_points = util.bucket(size)
+    if n_points < size:
+        raise ValueError(f"Cannot pad a design of {size} nodes to {n_points}")
+
+    params = {}
+    for key, value in design.__dict__.items():
+        if key == "mask":
+            params[key] = jnp.arange(n_points) < size
+            continue
+        value = jnp.asarray(value)
+        if key == "grid":
+            dx = value[size - 1] - value[size - 2]
+            params[key] = jnp.concatenate([
+                value[:size],
+                value[size - 1] + dx * jnp.arange(1, n_points - size + 1)
+            ])
+        elif value.ndim == 0:
+            params[key] = value
+        else:
+            params[key] = jnp.concatenate([
+                value[..., :size],
+                jnp.repeat(value[..., size - 1:size], n_points - size, axis=-1)
+            ], axis=-1)
+    params["mask"] = params["mask"].astype(f64)
+
+    return PVDesign(**params)
+
+
 def incident_light(kind: str = "sun",
                    Lambda: Array = None,
                    P_in: Array = None) -> LightSource:
@@ -220,57 +271,151 @@ def init_cell(design: PVDesign,
     return PVCell(**params)
 
 
-def equilibrium(design: PVDesign, ls: LightSource) -> Potentials:
+def prepare(design: PVDesign,
+            ls: LightSource,
+            optics: bool = True) -> PVCell:
+    """Initialize a cell, reusing the result of earlier calls with an identical design and light source
+
+    The generation density and grid spacing are computed once per design, light source and optics setting, and the CELL_CACHE_SIZE most recent cells are kept. Designs being traced, e.g. under jax.grad, are always initialized afresh.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+
+    Returns:
+        PVCell: An initialized cell ready for simulation
+    """
+    leaves, treedef = tree_util.tree_flatten((design, ls))
+    if any(isinstance(leaf, core.Tracer) for leaf in leaves):
+        return init_cell(design, ls, optics=optics)
+
+    digest = hashlib.sha1(str((treedef, optics)).encode())
+    for leaf in leaves:
+        leaf = np.asarray(leaf)
+        digest.update(str((leaf.shape, leaf.dtype)).encode())
+        digest.update(leaf.tobytes())
+    key = digest.hexdigest()
+
+    if key in _cells:
+        _cells.move_to_end(key)
+    else:
+        _cells[key] = init_cell(design, ls, optics=optics)
+        if len(_cells) > CELL_CACHE_SIZE:
+            _cells.popitem(last=False)
+
+    return _cells[key]
+
+
+def equilibrium(design: PVDesign,
+                ls: LightSource,
+                opts: SolverOptions = SolverOptions()) -> Potentials:
     """Solve equilibrium system for a cell
 
     Args:
         design (PVDesign): A cell
         ls (LightSource): A light source
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
 
     Returns:
         Potentials: Equilibrium potential and quasi-Fermi energies
     """
-    cell = init_cell(design, ls)
-    logger.info("Solving equilibrium...")
-    bound_eq = bcond.boundary_eq(cell)
-    pot_ini = solver.eq_guess(cell, bound_eq)
-    pot = solver.solve_eq(cell, bound_eq, pot_ini)
+    return solve_equilibrium(prepare(design, ls), opts)
 
-    return pot
 
+def solve_equilibrium(cell: PVCell,
+                      opts: SolverOptions = SolverOptions()) -> Potentials:
+    """Solve equilibrium system for an initialized cell
 
-def simulate(design: PVDesign,
-             ls: LightSource = incident_light(),
-             optics: bool = True,
-             n_steps: i64 = None,
-             verbose: bool = True) -> dict:
-    """Solve equilibrium and out-of-equilibrium systems for a cell.
+    The equilibrium does not depend on the generation density, so any cell of the design can be used.
 
     Args:
-        design (PVDesign): A cell
-        ls (LightSource): A light source
-        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. If False, model uses ijnput absorption coefficients as specified in the PVDesign object to calculate generation density. Defaults to True.
-        n_steps (i64, optional): How many voltage steps to solve for. May be useful when an IV curve of a specific range is needed, but unnecessary in other cases. Defaults to None.
+        cell (PVCell): An initialized cell
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
 
     Returns:
-        dict: Dictionary of results: "cell" is the initialized cell, "eq" is the equilibrium solution, "Voc" is the final solution beyond the open circuit voltage, "mpp" is the maximum power found in W, "eff" is the power conversion efficiency, "iv" is a tuple (v, i) of the IV curve
+        Potentials: Equilibrium potential and quasi-Fermi energies
     """
-    if not verbose:
-        temp = logger.level
-        logger.setLevel("WARNING")
+    logger.info("Solving equilibrium...")
+    bound_eq = bcond.boundary_eq(cell)
+    pot_ini = solver.eq_guess(cell, bound_eq)
+    if opts.reverse:
+        pot = solver.solve_eq_reverse(cell, bound_eq, pot_ini, opts)
+    else:
+        pot = solver.solve_eq(cell, bound_eq, pot_ini, opts)
 
-    pot_eq = equilibrium(design, ls)
+    return pot
 
-    cell = init_cell(design, ls, optics=optics)
+
+def refine(cell: PVCell, voltages: List[f64], currents: List[f64],
+           pots: List[Potentials], solve_pdd: Callable, opts: SolverOptions,
+           state: solver.SolverState, jtol: f64 = 0.5,
+           dv_mpp: f64 = 0.05,
+           dv_min: f64 = 0.005) -> Iterator[Tuple[f64, f64, Potentials]]:
+
+    # Bisect the intervals over which the current changes by more than jtol
+    # of the short-circuit current, and those next to the best sampled power
+    # point until they are narrower than dv_mpp, guessing from the
+    # neighbouring solutions. Past open circuit only the interval of the
+    # zero crossing is refined.
+    def coarse(i):
+        dv = voltages[i + 1] - voltages[i]
+        if dv <= 2 * dv_min / scales.energy or currents[i] < 0:
+            return False
+        if jnp.abs(currents[i + 1] - currents[i]) > jtol * jnp.abs(
+                currents[0]):
+            return True
+        best = jnp.argmax(jnp.array(voltages) * jnp.array(currents))
+        return i in (best - 1, best) and dv > dv_mpp / scales.energy
+
+    i = 0
+    while i < len(voltages) - 1:
+        if not coarse(i):
+            i += 1
+            continue
+        dv = voltages[i + 1] - voltages[i]
+        v = voltages[i] + dv / 2
+        logger.info("Refining at {:.3f} V...".format(v * scales.energy))
+        guess = solver.genlinguess(pots[i], pots[i + 1], -dv, dv / 2)
+        total_j, pot = solve_pdd(cell, v, guess, opts, state)
+        voltages.insert(i + 1, v)
+        currents.insert(i + 1, total_j)
+        pots.insert(i + 1, pot)
+        i = 0
+        yield v, total_j, pot
+
+
+def bias_points(cell: PVCell,
+                pot_eq: Potentials,
+                n_steps: i64 = None,
+                opts: SolverOptions = SolverOptions(),
+                adaptive: bool = False) -> Iterator[dict]:
+
+    # Solutions along the voltage sweep as they converge. Only the last three
+    # are kept for the predictors, except that adaptive stepping keeps all of
+    # them to refine between.
     currents = jnp.array([], dtype=f64)
     voltages = jnp.array([], dtype=f64)
     dv = solver.vincr(cell)
     pots = []
     vstep = 0
+    state = solver.SolverState()
+    solve_pdd = adjoint.solve_pdd_reverse if opts.reverse else adjoint.solve_pdd
+
+    def point(v, total_j, pot):
+        return {
+            "v": scales.energy * v,
+            "j": scales.current * total_j,
+            "pot": pot,
+            "stats": dict(state.stats)
+        }
 
     while vstep < 100:
 
-        v = dv * vstep
+        if adaptive and vstep > 1:
+            v = voltages[-1] + dv
+        else:
+            v = dv * vstep
         scaled_v = v * scales.energy
         logger.info("Solving for {:.2f} V (Step {:3d})...".format(
             scaled_v, vstep))
@@ -278,35 +423,50 @@ def simulate(design: PVDesign,
         if vstep == 0:
             # Just use a rough guess from equilibrium
             guess = solver.ooe_guess(cell, pot_eq)
-            total_j, pot = adjoint.solve_pdd(cell, v, guess)
+            total_j, pot = solve_pdd(cell, v, guess, opts, state)
         elif vstep == 1:
             # Solve for a voltage close to zero for linear guess
             potl = pot
             logger.info(
                 "Solving for {:.2f} V for convergence...".format(DIM_V_INIT))
             vinit = DIM_V_INIT / scales.energy
-            _, potinit = adjoint.solve_pdd(cell, vinit, pot)
+            _, potinit = solve_pdd(cell, vinit, pot, opts, state)
             # Generate linear guess
             logger.info(f"Continuing...")
             guess = solver.genlinguess(potinit, pot, vinit, dv - vinit)
-            total_j, pot = adjoint.solve_pdd(cell, v, guess)
+            total_j, pot = solve_pdd(cell, v, guess, opts, state)
         elif vstep == 2:
             # Generate linear guess from first two steps
             potll = potl
-            guess = solver.linguess(pot, potl)
-            total_j, new = adjoint.solve_pdd(cell, v, guess)
+            if adaptive:
+                guess = solver.genlinguess(pot, potl,
+                                           voltages[-1] - voltages[-2],
+                                           v - voltages[-1])
+            else:
+                guess = solver.linguess(pot, potl)
+            total_j, new = solve_pdd(cell, v, guess, opts, state)
             potl, pot = pot, new
         else:
             # Generate quadratic guess from last three steps
-            guess = solver.quadguess(pot, potl, potll)
-            total_j, new = adjoint.solve_pdd(cell, v, guess)
+            if adaptive:
+                guess = solver.genquadguess(pot, potl, potll, voltages[-1],
+                                            voltages[-2], voltages[-3], v)
+            else:
+                guess = solver.quadguess(pot, potl, potll)
+            total_j, new = solve_pdd(cell, v, guess, opts, state)
             potll, potl, pot = potl, pot, new
 
-        pots.append(pot)
+        if adaptive:
+            pots.append(pot)
         currents = jnp.append(currents, total_j)
-        voltages = jnp.append(voltages, dv * vstep)
+        voltages = jnp.append(voltages, v)
         vstep += 1
 
+        yield point(v, total_j, pot)
+
+        if adaptive and vstep > 1:
+            dv = solver.vadapt(voltages, currents, state.stats["niter"])
+
         if n_steps is not None:
             if vstep == n_steps:
                 break
@@ -316,8 +476,78 @@ def simulate(design: PVDesign,
             if (ll * l <= 0) or l < 0:
                 break
 
-    dim_currents = scales.current * currents
-    dim_voltages = scales.energy * voltages
+    if adaptive:
+        for v, total_j, pot in refine(cell, list(voltages), list(currents),
+                                      pots, solve_pdd, opts, state):
+            yield point(v, total_j, pot)
+
+
+def simulate_iter(design: PVDesign,
+                  ls: LightSource = incident_light(),
+                  optics: bool = True,
+                  n_steps: i64 = None,
+                  opts: SolverOptions = SolverOptions(),
+                  adaptive: bool = False) -> Iterator[dict]:
+    """Solve equilibrium, then yield every bias point of the IV sweep as soon as it has converged
+
+    Only the solutions needed by the predictors are kept in memory, except with adaptive stepping, which refines between all of them after reaching open circuit and therefore yields the refined points out of voltage order.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        n_steps (i64, optional): How many voltage steps to solve for. Defaults to None, i.e. until the current changes sign.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings, as in simulate. Defaults to SolverOptions().
+        adaptive (bool, optional): Whether to adapt the voltage step to the IV curve, as in simulate. Defaults to False.
+
+    Yields:
+        dict: Bias point: "v" is the voltage in V, "j" the current in A/cm^2, "pot" the solution and "stats" the Newton statistics of its solve, with "fallback" set if it needed the banded LU fallback
+    """
+    cell = prepare(design, ls, optics=optics)
+    pot_eq = solve_equilibrium(cell, opts)
+
+    yield from bias_points(cell, pot_eq, n_steps, opts, adaptive)
+
+
+def simulate(design: PVDesign,
+             ls: LightSource = incident_light(),
+             optics: bool = True,
+             n_steps: i64 = None,
+             verbose: bool = True,
+             opts: SolverOptions = SolverOptions(),
+             adaptive: bool = False) -> dict:
+    """Solve equilibrium and out-of-equilibrium systems for a cell.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. If False, model uses ijnput absorption coefficients as specified in the PVDesign object to calculate generation density. Defaults to True.
+        n_steps (i64, optional): How many voltage steps to solve for. May be useful when an IV curve of a specific range is needed, but unnecessary in other cases. Defaults to None.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings, e.g. SolverOptions(linsolver="block") for the direct block-tridiagonal solver or SolverOptions(compiled=True) to run each Newton solve as a single XLA call. With SolverOptions(reuse_precond=True) the GMRES preconditioner is kept across Newton iterations and voltages until it needs more than refactor_iters iterations, which needs linsolver "gmres" or "jfnk", and SolverOptions(linsolver="jfnk") solves Jacobian-free with jvps of the residual. SolverOptions(forcing="ew") loosens the GMRES tolerance far from convergence (Eisenstat-Walker), also with linsolver "gmres" or "jfnk" only. SolverOptions(globalization="linesearch") replaces the momentum heuristic by an Armijo backtracking line search, which is slower on easy steps but far more robust. SolverOptions(reverse=True) differentiates each solve with a reverse-mode adjoint, so jax.grad costs one transposed banded solve per voltage however many design parameters there are. Defaults to SolverOptions().
+        adaptive (bool, optional): Whether to adapt the voltage step to the IV curve, taking large steps where the current is flat and small ones around the maximum power point and open circuit, which usually needs fewer solves for the same efficiency. Defaults to False.
+
+    Returns:
+        dict: Dictionary of results: "cell" is the initialized cell, "eq" is the equilibrium solution, "Voc" is the final solution beyond the open circuit voltage, "mpp" is the maximum power found in W, "eff" is the power conversion efficiency, "iv" is a tuple (v, i) of the IV curve
+    """
+    if not verbose:
+        temp = logger.level
+        logger.setLevel("WARNING")
+
+    cell = prepare(design, ls, optics=optics)
+    pot_eq = solve_equilibrium(cell, opts)
+    points = list(bias_points(cell, pot_eq, n_steps, opts, adaptive))
+
+    if adaptive:
+        # sort the refined points in and drop those past the first negative
+        # current
+        points.sort(key=lambda point: float(point["v"]))
+        n = next((i + 1 for i, point in enumerate(points) if point["j"] < 0),
+                 len(points))
+        points = points[:n]
+
+    dim_voltages = jnp.stack([point["v"] for point in points])
+    dim_currents = jnp.stack([point["j"] for point in points])
+    pots = [point["pot"] for point in points]
 
     pmax, vmax = spline.calcPmax(dim_voltages,
                                  dim_currents * 1e4)  # A/cm^2 -> A/m2
@@ -343,18 +573,594 @@ def simulate(design: PVDesign,
     return results
 
 
+def mpp(design: PVDesign,
+        ls: LightSource = incident_light(),
+        optics: bool = True,
+        dv: f64 = 0.1,
+        tol: f64 = 1e-4,
+        verbose: bool = True,
+        opts: SolverOptions = SolverOptions()) -> dict:
+    """Locate the maximum power point without sweeping the IV curve up to open circuit
+
+    A coarse sweep stops as soon as the power decreases, which brackets the maximum power point. The root of d(VJ)/dV = J + V dJ/dV is then refined by regula falsi (Illinois), where dJ/dV and the predictor for the next solve come from the implicit function theorem. The search is not differentiated: by the envelope theorem, the gradient of the maximum power is that of the power at the fixed optimal voltage, so only the final solve is.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        dv (f64, optional): Voltage step of the coarse sweep in V. Defaults to 0.1.
+        tol (f64, optional): Tolerance on the optimal voltage in V. Defaults to 1e-4.
+        verbose (bool, optional): Whether to log the solves. Defaults to True.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        dict: Dictionary of results: "mpp" is the maximum power in W, "eff" is the power conversion efficiency, "vmax" is the voltage of maximum power, "pot" is the solution there and "niter" is the number of regula falsi iterations
+
+    Raises:
+        ValueError: If the power still increases after 100 steps of dv
+    """
+    if not verbose:
+        temp = logger.level
+        logger.setLevel("WARNING")
+
+    cell = prepare(design, ls, optics=optics)
+    fixed = tree_util.tree_map(lax.stop_gradient, cell)
+    state = solver.SolverState()
+
+    def evaluate(v, guess):
+        # current, solution and their derivatives with respect to the voltage
+        logger.info("Solving for {:.4f} V...".format(v * scales.energy))
+        (j, pot), (dj, dpot) = jvp(
+            lambda v: adjoint.solve_pdd(fixed, v, guess, opts, state), (v, ),
+            (1., ))
+        return {"v": v, "g": j + v * dj, "pot": pot, "dpot": dpot}
+
+    def predict(point, v):
+        return tree_util.tree_map(lambda x, dx: x + (v - point["v"]) * dx,
+                                  point["pot"], point["dpot"])
+
+    pot_eq = solve_equilibrium(fixed, opts)
+    left = evaluate(0., solver.ooe_guess(fixed, pot_eq))
+    step = dv / scales.energy
+    right = evaluate(step, predict(left, step))
+    vstep = 1
+    while right["g"] > 0:
+        if vstep == 100:
+            if not verbose:
+                logger.setLevel(temp)
+            raise ValueError(
+                "No maximum power point below {:.2f} V".format(
+                    right["v"] * scales.energy))
+        left = right
+        right = evaluate(left["v"] + step, predict(left, left["v"] + step))
+        vstep += 1
+
+    niter = 0
+    side = 0
+    while right["v"] - left["v"] > tol / scales.energy and niter < 50:
+        v = (left["v"] * right["g"] - right["v"] * left["g"]) / (right["g"] -
+                                                                left["g"])
+        near = left if v - left["v"] < right["v"] - v else right
+        point = evaluate(v, predict(near, v))
+        niter += 1
+        if point["g"] > 0:
+            left = point
+            if side == 1:
+                right["g"] = right["g"] / 2
+            side = 1
+        else:
+            right = point
+            if side == -1:
+                left["g"] = left["g"] / 2
+            side = -1
+        if point["g"] == 0:
+            break
+
+    best = left if jnp.abs(left["g"]) < jnp.abs(right["g"]) else right
+    vmax = best["v"]
+    j, pot = adjoint.solve_pdd(cell, vmax, best["pot"], opts)
+    pmax = scales.energy * vmax * scales.current * j * 1e4  # A/cm^2 -> A/m2
+    eff = pmax / jnp.sum(ls.P_in)
+
+    logger.info("Maximum power point at {:.4f} V with efficiency {}%.".format(
+        vmax * scales.energy, jnp.round(eff * 100, 2)))
+
+    if not verbose:
+        logger.setLevel(temp)
+
+    return {
+        "mpp": pmax,
+        "eff": eff,
+        "vmax": scales.energy * vmax,
+        "pot": pot,
+        "niter": niter
+    }
+
+
+def solve_at(cell: PVCell, v: f64, guess: Potentials,
+             opts: SolverOptions) -> Tuple[f64, Potentials, bool]:
+
+    pot, stats = solver.solve_compiled(cell, bcond.boundary(cell, v), guess,
+                                       opts)
+
+    return current.total_current(cell, pot), pot, stats["converged"]
+
+
+def short_circuit(design: PVDesign, ls: LightSource, optics: bool,
+                  opts: SolverOptions) -> tuple:
+
+    cell = init_cell(design, ls, optics=optics)
+    bound_eq = bcond.boundary_eq(cell)
+    pot_eq, stats_eq = solver.solve_eq_compiled(
+        cell, bound_eq, solver.eq_guess(cell, bound_eq))
+    j0, pot0, c0 = solve_at(cell, 0., solver.ooe_guess(cell, pot_eq), opts)
+
+    return cell, pot_eq, j0, pot0, c0 & stats_eq["converged"]
+
+
+def first_steps(design: PVDesign, ls: LightSource, optics: bool,
+                opts: SolverOptions) -> tuple:
+
+    # equilibrium and the first three voltage steps, which have their own
+    # predictors in simulate
+    cell, pot_eq, j0, pot0, c0 = short_circuit(design, ls, optics, opts)
+    dv = solver.vincr(cell)
+
+    vinit = DIM_V_INIT / scales.energy
+    _, potinit, cinit = solve_at(cell, vinit, pot0, opts)
+    j1, pot1, c1 = solve_at(
+        cell, dv, solver.genlinguess(potinit, pot0, vinit, dv - vinit), opts)
+    j2, pot2, c2 = solve_at(cell, 2 * dv, solver.linguess(pot1, pot0), opts)
+    c0 = c0 & cinit
+
+    return cell, pot_eq, (j0, j1, j2), (pot0, pot1, pot2), (c0, c1, c2)
+
+
+@partial(jit, static_argnums=(2, 3))
+def jsc(design: PVDesign,
+        ls: LightSource = incident_light(),
+        optics: bool = True,
+        opts: SolverOptions = SolverOptions()) -> f64:
+    """Short-circuit current density of a cell, from a single solve at 0 V
+
+    Compiled, differentiable and vmap-able over designs.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        f64: Short-circuit current density in A/cm^2, or NaN if a solve did not converge
+    """
+    _, _, j0, _, converged = short_circuit(design, ls, optics, opts)
+
+    return jnp.where(converged, scales.current * j0, jnp.nan)
+
+
+@partial(jit, static_argnums=(2, 3, 4, 5))
+def voc(design: PVDesign,
+        ls: LightSource = incident_light(),
+        optics: bool = True,
+        dv: f64 = 0.1,
+        tol: f64 = 1e-6,
+        opts: SolverOptions = SolverOptions()) -> f64:
+    """Open-circuit voltage of a cell, without sweeping the IV curve
+
+    Steps of dv from short circuit, each predicted from the derivative of the solution with respect to the voltage (implicit function theorem), stop once the current is negative. Newton on J(V) = 0 then converges monotonically from there, as J is concave in V. Compiled, differentiable through one final Newton step at the stopped root, and vmap-able over designs.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        dv (f64, optional): Voltage step before bracketing open circuit in V. Defaults to 0.1.
+        tol (f64, optional): Tolerance of the Newton iterations in V. Defaults to 1e-6.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        f64: Open-circuit voltage in V, or NaN if the current stays positive up to 100 steps or a solve did not converge
+    """
+    cell, _, j0, pot0, converged = short_circuit(design, ls, optics, opts)
+    fixed = tree_util.tree_map(lax.stop_gradient, cell)
+
+    # a point is (v, J, dJ/dV, solution, its derivative, whether all solves
+    # so far converged)
+    def evaluate(cell, v, guess, ok):
+        (j, pot, conv), (dj, dpot, _) = jvp(
+            lambda v: solve_at(cell, v, guess, opts), (v, ), (1., ))
+        return v, j, dj, pot, dpot, ok & conv
+
+    def predict(point, v):
+        vl, _, _, pot, dpot, _ = point
+        return tree_util.tree_map(lambda x, dx: x + (v - vl) * dx, pot, dpot)
+
+    def update(point):
+        _, j, dj, _, _, _ = point
+        return j / jnp.where(dj == 0, 1., dj)
+
+    def march(carry):
+        i, point = carry
+        v = point[0] + dv / scales.energy
+        return i + 1, evaluate(fixed, v, predict(point, v), point[5])
+
+    def newton(carry):
+        i, point = carry
+        v = point[0] - update(point)
+        return i + 1, evaluate(fixed, v, predict(point, v),
+                               point[5] & (point[2] != 0))
+
+    start = evaluate(fixed, 0., pot0, converged)
+    n, point = lax.while_loop(
+        lambda c: (c[1][1] > 0) & c[1][5] & (c[0] < 100), march, (0, start))
+    m, point = lax.while_loop(
+        lambda c: (jnp.abs(update(c[1])) > tol / scales.energy) & c[1][5] &
+        (c[0] < 20), newton, (0, point))
+
+    # only the last Newton step is differentiated, which at the root gives
+    # dVoc = -dJ / (dJ/dV) by the implicit function theorem
+    v, _, dj, pot, _, ok = lax.stop_gradient(point)
+    j, _, conv = solve_at(cell, v, pot, opts)
+    voc = scales.energy * (v - j / jnp.where(dj == 0, 1., dj))
+    ok = ok & conv & (dj != 0) & (n < 100) & (m < 20)
+
+    return jnp.where(ok, voc, jnp.nan)
+
+
+@partial(jit, static_argnums=(2, 3, 4))
+def sweep(design: PVDesign,
+          ls: LightSource = incident_light(),
+          optics: bool = True,
+          n_steps: i64 = 20,
+          opts: SolverOptions = SolverOptions()) -> dict:
+    """Solve equilibrium and a fixed number of voltage steps as a single jitted, vmappable computation
+
+    Same predictors as simulate, but the sweep is a lax.scan over preallocated outputs and does not stop at the open circuit voltage. Non-converged steps are flagged instead of falling back to a dense solver.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        n_steps (i64, optional): Number of voltage steps, at least 3. Defaults to 20.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        dict: Dictionary of results as in simulate, with "pots" stacked along the first axis and "converged" flagging every voltage step
+    """
+    assert n_steps >= 3, "sweep needs at least 3 voltage steps"
+
+    cell, pot_eq, (j0, j1, j2), (pot0, pot1, pot2), (c0, c1, c2) = first_steps(
+        design, ls, optics, opts)
+    dv = solver.vincr(cell)
+
+    def step(carry, v):
+        pot, potl, potll = carry
+        j, new, conv = solve_at(cell, v, solver.quadguess(pot, potl, potll),
+                                opts)
+        return (new, pot, potl), (j, new, conv)
+
+    voltages = dv * jnp.arange(n_steps)
+    _, (js, pots, convs) = lax.scan(step, (pot2, pot1, pot0), voltages[3:])
+
+    stack = lambda first, rest: jnp.concatenate([jnp.stack(first), rest])
+    currents = stack([j0, j1, j2], js)
+    pots = tree_util.tree_map(lambda a, b, c, rest: stack([a, b, c], rest),
+                              pot0, pot1, pot2, pots)
+    converged = stack([c0, c1, c2], convs)
+
+    return sweep_results(cell, pot_eq, ls, voltages, currents, pots,
+                         converged)
+
+
+@partial(jit, static_argnums=(2, 3, 4, 5))
+def sweep_parallel(design: PVDesign,
+                   ls: LightSource = incident_light(),
+                   optics: bool = True,
+                   n_steps: i64 = 20,
+                   stride: i64 = 4,
+                   opts: SolverOptions = SolverOptions()) -> dict:
+    """Solve a fixed number of voltage steps simultaneously, with guesses from a coarse sweep
+
+    Only every stride-th voltage is solved in sequence, each predicted from the derivative of the previous solution with respect to the voltage (implicit function theorem). Every voltage is then solved at once with the Newton iterations vectorized across voltages, starting from the nearest coarse solution extrapolated along its derivative, so that the latency is that of the hardest voltage rather than the sum over all of them.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        n_steps (i64, optional): Number of voltage steps. Defaults to 20.
+        stride (i64, optional): Number of voltage steps between the solves of the coarse sweep. Defaults to 4.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        dict: Dictionary of results as in sweep
+    """
+    cell, pot_eq, _, pot0, c0 = short_circuit(design, ls, optics, opts)
+    fixed = tree_util.tree_map(lax.stop_gradient, cell)
+    voltages = solver.vincr(cell) * jnp.arange(n_steps)
+
+    def evaluate(v, guess):
+        (_, pot), (_, dpot) = jvp(
+            lambda v: solve_at(fixed, v, guess, opts)[:2], (v, ), (1., ))
+        return pot, dpot
+
+    def coarse(carry, v):
+        vl, pot, dpot = carry
+        guess = tree_util.tree_map(lambda x, dx: x + (v - vl) * dx, pot,
+                                   dpot)
+        pot, dpot = evaluate(v, guess)
+        return (v, pot, dpot), (pot, dpot)
+
+    vc = voltages[::stride]
+    start = evaluate(0., lax.stop_gradient(pot0))
+    _, (pots, dpots) = lax.scan(coarse, (0., *start), vc[1:])
+    pots, dpots = tree_util.tree_map(
+        lambda a, rest: jnp.concatenate([a[None], rest]), start,
+        (pots, dpots))
+
+    nearest = jnp.clip(jnp.round(jnp.arange(n_steps) / stride).astype(int), 0,
+                       vc.size - 1)
+    guesses = tree_util.tree_map(
+        lambda x, dx: x[nearest] + (voltages - vc[nearest]).reshape(-1, 1) *
+        dx[nearest], pots, dpots)
+    currents, pots, converged = vmap(solve_at, (None, 0, 0, None))(
+        cell, voltages, guesses, opts)
+
+    return sweep_results(cell, pot_eq, ls, voltages, currents, pots,
+                         converged & c0)
+
+
+def sweep_results(cell: PVCell, pot_eq: Potentials, ls: LightSource,
+                  voltages: Array, currents: Array, pots: Potentials,
+                  converged: Array) -> dict:
+
+    dim_currents = scales.current * currents
+    dim_voltages = scales.energy * voltages
+    pmax, vmax = spline.calcPmax(dim_voltages,
+                                 dim_currents * 1e4)  # A/cm^2 -> A/m2
+    eff = pmax / jnp.sum(ls.P_in)
+
+    results = {
+        "cell": cell,
+        "eq": pot_eq,
+        "pots": pots,
+        "mpp": pmax,
+        "eff": eff,
+        "vmax": vmax,
+        "iv": (dim_voltages, dim_currents),
+        "converged": converged
+    }
+
+    return results
+
+
+@partial(jit, static_argnums=(2, 3, 4))
+def sweep_batch(designs: PVDesign, ls: LightSource, optics: bool,
+                max_steps: i64, opts: SolverOptions) -> dict:
+
+    # Designs are stacked along the first axis. All of them step through the
+    # same voltages, and a design that has passed open circuit (or failed to
+    # converge) is frozen by re-solving at its last voltage from its own
+    # solution, which takes a single Newton iteration.
+    cells, _, (j0, j1, j2), (pot0, pot1, pot2), (c0, c1, c2) = vmap(
+        first_steps, (0, None, None, None))(designs, ls, optics, opts)
+    dv = solver.vincr(cells)
+    nb = j0.size
+
+    currents = jnp.zeros((nb, max_steps)).at[:, :3].set(
+        jnp.stack([j0, j1, j2], axis=1))
+    converged = c0 & c1 & c2
+    active = jnp.logical_and(converged, (j1 * j2 > 0) & (j2 >= 0))
+    n_steps = jnp.full(nb, 3)
+    vlast = jnp.full(nb, 2 * dv)
+
+    def advance(cell, pot, potl, potll, active, vlast, v):
+        guess = tree_util.tree_map(lambda q, p: jnp.where(active, q, p),
+                                   solver.quadguess(pot, potl, potll), pot)
+        return solve_at(cell, jnp.where(active, v, vlast), guess, opts)
+
+    def cond_fun(carry):
+        i, _, _, _, active, _, _, _, _ = carry
+        return jnp.logical_and(i < max_steps, jnp.any(active))
+
+    def body_fun(carry):
+        i, pot, potl, potll, active, vlast, n_steps, currents, converged = carry
+        v = dv * i
+        j, new, conv = vmap(advance, (0, 0, 0, 0, 0, 0, None))(
+            cells, pot, potl, potll, active, vlast, v)
+        keep = lambda a, b: jnp.where(
+            active.reshape((-1, ) + (1, ) * (a.ndim - 1)), a, b)
+        currents = currents.at[:, i].set(jnp.where(active, j, 0))
+        converged = jnp.where(active, converged & conv, converged)
+        n_steps = jnp.where(active, i + 1, n_steps)
+        jl = currents[:, i - 1]
+        passed = (jl * j <= 0) | (j < 0)
+        return (i + 1, tree_util.tree_map(keep, new, pot),
+                tree_util.tree_map(keep, pot, potl),
+                tree_util.tree_map(keep, potl, potll),
+                active & ~passed & conv, jnp.where(active, v,
+                                                   vlast), n_steps, currents,
+                converged)
+
+    carry = (3, pot2, pot1, pot0, active, vlast, n_steps, currents, converged)
+    carry = lax.while_loop(cond_fun, body_fun, carry)
+    _, _, _, _, _, _, n_steps, currents, converged = carry
+
+    voltages = dv * jnp.arange(max_steps)
+    dim_currents = scales.current * currents
+    dim_voltages = scales.energy * voltages
+    mask = jnp.arange(max_steps) < n_steps.reshape(-1, 1)
+    pmax, vmax = vmap(spline.calcPmax,
+                      (None, 0, 0))(dim_voltages, dim_currents * 1e4,
+                                    mask)  # A/cm^2 -> A/m2
+    eff = pmax / jnp.sum(ls.P_in)
+
+    results = {
+        "mpp": pmax,
+        "eff": eff,
+        "vmax": vmax,
+        "iv": (dim_voltages, dim_currents),
+        "n_steps": n_steps,
+        "converged": converged
+    }
+
+    return results
+
+
+def simulate_batch(designs: Union[List[PVDesign], PVDesign],
+                   ls: LightSource = incident_light(),
+                   optics: bool = True,
+                   max_steps: i64 = 100,
+                   opts: SolverOptions = SolverOptions()) -> dict:
+    """Simulate many designs of equal grid size as a single vectorized computation
+
+    Every design steps through the voltages until its current changes sign, like simulate, but all of them advance together in one compiled loop. Non-converged designs are flagged and frozen rather than retried with a dense solver.
+
+    Args:
+        designs (Union[List[PVDesign], PVDesign]): Designs with the same number of grid points, or a PVDesign whose fields are stacked along a leading batch axis
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        max_steps (i64, optional): Maximum number of voltage steps. Defaults to 100.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        dict: Dictionary of batched results: "mpp", "eff" and "vmax" as in simulate, "iv" is a tuple (v, i) of shared voltages and currents per design, valid for the first "n_steps" entries, and "converged" flags designs whose solves all converged
+    """
+    if isinstance(designs, (list, tuple)):
+        designs = tree_util.tree_map(
+            lambda *xs: jnp.stack([jnp.asarray(x, dtype=f64) for x in xs]),
+            *designs)
+
+    return sweep_batch(designs, ls, optics, max_steps, opts)
+
+
+@partial(jit, static_argnums=(4, ))
+def current_pullback(cell: PVCell, v: f64, pot: Potentials, w: f64,
+                     opts: SolverOptions) -> PVCell:
+    # pot is a converged solution, so only the adjoint pass is replayed
+    dcell, _, _ = adjoint.solve_pdd_reverse_bwd(
+        opts, None, (cell, v, pot), (w, objects.zero_pot(pot.phi.size)))
+
+    return dcell
+
+
+def eff_and_grad(design: PVDesign,
+                 ls: LightSource = incident_light(),
+                 optics: bool = True,
+                 verbose: bool = True,
+                 opts: SolverOptions = SolverOptions()) -> Tuple[f64, PVDesign]:
+    """Efficiency of a cell and its gradient with respect to the design, without storing the autodiff tape of the sweep
+
+    The sweep is first run without differentiation, keeping the solution at each voltage as a checkpoint. The cotangent of the cell is then accumulated one bias point at a time, replaying only the adjoint pass at its checkpoint, i.e. a single transposed banded solve, and pulled back through the cell initialization, including the optics, once.
+
+    Args:
+        design (PVDesign): A cell
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        verbose (bool, optional): Whether to log the sweep. Defaults to True.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        Tuple[f64, PVDesign]: Efficiency and its gradient, with the same structure as design
+    """
+    if not verbose:
+        temp = logger.level
+        logger.setLevel("WARNING")
+
+    design = tree_util.tree_map(lambda x: jnp.asarray(x, dtype=f64), design)
+    results = simulate(design, ls, optics=optics, opts=opts)
+    dim_voltages, dim_currents = results["iv"]
+
+    def efficiency(dim_currents):
+        pmax, _ = spline.calcPmax(dim_voltages, dim_currents * 1e4)
+        return pmax / jnp.sum(ls.P_in)
+
+    eff, weights = value_and_grad(efficiency)(dim_currents)
+    weights = weights * scales.current
+
+    cell, cell_vjp = vjp(lambda d: init_cell(d, ls, optics=optics), design)
+    dcell = tree_util.tree_map(jnp.zeros_like, cell)
+    for v, pot, w in zip(dim_voltages / scales.energy, results["pots"],
+                         weights):
+        dcell = tree_util.tree_map(jnp.add, dcell,
+                                   current_pullback(cell, v, pot, w, opts))
+    grad, = cell_vjp(dcell)
+
+    if not verbose:
+        logger.setLevel(temp)
+
+    return eff, grad
+
+
+@partial(jit, static_argnums=(0, 5, 6))
+def current_jacobian(fun: Callable[[Array], PVDesign], theta: Array,
+                     ls: LightSource, v: f64, pot: Potentials, optics: bool,
+                     opts: SolverOptions) -> Array:
+    # all parameter directions share one factorization of the PDD Jacobian
+    basis = jnp.eye(theta.size)
+    cell, cell_lin = linearize(lambda t: init_cell(fun(t), ls, optics=optics),
+                               theta)
+    dcells = vmap(cell_lin)(basis)
+
+    _, F_lin = linearize(lambda c: adjoint.F_wb(c, v, pot), cell)
+    rhs = vmap(F_lin)(dcells)
+    spJ = solver.jacobian(cell, bcond.boundary(cell, v), pot, opts)
+    dpots = vmap(solver.vec2pot)(linalg.bandsol(spJ, -rhs.T).T)
+
+    _, J_lin = linearize(current.total_current, cell, pot)
+
+    return vmap(J_lin)(dcells, dpots)
+
+
+def iv_jacobian(fun: Callable[[Array], PVDesign],
+                theta: Array,
+                ls: LightSource = incident_light(),
+                optics: bool = True,
+                verbose: bool = True,
+                opts: SolverOptions = SolverOptions()) -> Tuple[Array, Array, Array]:
+    """Sensitivities of the IV curve to many design parameters at once
+
+    The sweep is run once, then at each voltage the PDD Jacobian is factored a single time and solved for all parameter directions as one multi-column right-hand side.
+
+    Args:
+        fun (Callable[[Array], PVDesign]): Hashable function mapping parameters to a design
+        theta (Array): Parameters to differentiate with respect to
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        verbose (bool, optional): Whether to log the sweep. Defaults to True.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        Tuple[Array, Array, Array]: Voltages in V, currents in A/cm^2 and their Jacobian with respect to theta, of shape (voltages, parameters)
+    """
+    theta = jnp.asarray(theta, dtype=f64)
+    results = simulate(fun(theta),
+                       ls,
+                       optics=optics,
+                       verbose=verbose,
+                       opts=opts)
+    dim_voltages, dim_currents = results["iv"]
+
+    jac = jnp.stack([
+        current_jacobian(fun, theta, ls, v, pot, optics, opts)
+        for v, pot in zip(dim_voltages / scales.energy, results["pots"])
+    ])
+
+    return dim_voltages, dim_currents, scales.current * jac
+
+
 def eff_at_bias(design: PVDesign,
                 bias: f64,
                 pot_ini: Potentials,
                 ls: LightSource = incident_light(),
                 optics: bool = True,
-                verbose: bool = True) -> Tuple[f64, Potentials]:
+                verbose: bool = True,
+                opts: SolverOptions = SolverOptions()) -> Tuple[f64, Potentials]:
     if not verbose:
         temp = logger.level
         logger.setLevel("WARNING")
 
-    cell = init_cell(design, ls, optics=optics)
-    j, pot = adjoint.solve_pdd(cell, bias / scales.energy, pot_ini)
+    cell = prepare(design, ls, optics=optics)
+    j, pot = adjoint.solve_pdd(cell, bias / scales.energy, pot_ini, opts)
     current = j * scales.current
     power = current * bias
     eff = power * 1e4 / jnp.sum(ls.P_in)
@@ -363,3 +1169,46 @@ def eff_at_bias(design: PVDesign,
         logger.setLevel(temp)
 
     return eff, pot
+
+
+def eff_hvp(fun: Callable[[Array], PVDesign],
+            theta: Array,
+            vec: Array,
+            bias: f64,
+            pot_ini: Potentials,
+            ls: LightSource = incident_light(),
+            optics: bool = True,
+            verbose: bool = True,
+            opts: SolverOptions = SolverOptions()) -> Tuple[f64, Array, Array]:
+    """Efficiency at a bias with its gradient and Hessian-vector product, for second-order optimizers
+
+    Forward-over-reverse differentiation through the implicit function theorem, where every linear solve reuses the banded factorization of its bias point.
+
+    Args:
+        fun (Callable[[Array], PVDesign]): Function mapping parameters to a design
+        theta (Array): Parameters
+        vec (Array): Direction of the Hessian-vector product
+        bias (f64): Bias voltage in V
+        pot_ini (Potentials): Initial guess of solution
+        ls (LightSource): A light source
+        optics (bool, optional): Whether to use optical model to calculate the absorption coefficients. Defaults to True.
+        verbose (bool, optional): Whether to log the solve. Defaults to True.
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        Tuple[f64, Array, Array]: Efficiency, its gradient and the Hessian-vector product with vec
+    """
+    def eff(theta):
+        return eff_at_bias(fun(theta),
+                           bias,
+                           pot_ini,
+                           ls,
+                           optics=optics,
+                           verbose=verbose,
+                           opts=opts)[0]
+
+    theta = jnp.asarray(theta, dtype=f64)
+    vec = jnp.asarray(vec, dtype=f64)
+    (value, grad), (_, hvp) = jvp(value_and_grad(eff), (theta, ), (vec, ))
+
+    return value, grad, hvp
@@ -1,7 +1,10 @@
 from deltapv import objects, residual, linalg, physics, scales, util
-from jax import numpy as jnp, jit, ops, custom_jvp, jvp, jacfwd, vmap, lax
+from jax import numpy as jnp, jit, ops, custom_jvp, custom_vjp, jvp, vjp, jacfwd, vmap, lax
+from functools import partial
 from typing import Tuple, Callable
 import matplotlib.pyplot as plt
+import numpy as np
+import jax
 import logging
 logger = logging.getLogger("deltapv")
 
@@ -9,12 +12,25 @@ PVCell = objects.PVCell
 LightSource = objects.LightSource
 Potentials = objects.Potentials
 Boundary = objects.Boundary
+SolverOptions = objects.SolverOptions
 Array = util.Array
 f64 = util.f64
 i64 = util.i64
 n_lnsrch = 500
 
 
+class SolverState:
+    """Mutable state carried between consecutive solves, e.g. along a voltage sweep
+
+    Attributes:
+        fact (Array): Last ILU factorization of the PDD Jacobian, reused as GMRES preconditioner when SolverOptions(reuse_precond=True) or SolverOptions(linsolver="jfnk")
+        stats (dict): Newton statistics of the last solve
+    """
+    def __init__(self):
+        self.fact = None
+        self.stats = {}
+
+
 def vincr(cell: PVCell, num_vals: i64 = 20) -> f64:
 
     dv = 1 / num_vals / scales.energy
@@ -22,6 +38,40 @@ def vincr(cell: PVCell, num_vals: i64 = 20) -> f64:
     return dv
 
 
+def vadapt(voltages: Array,
+           currents: Array,
+           niter: i64,
+           jtol: f64 = 0.5,
+           dv_min: f64 = 0.005,
+           dv_max: f64 = 0.2) -> f64:
+
+    # Next voltage step, such that the current changes by about jtol of the
+    # short-circuit current. The slope of the IV curve is modelled as growing
+    # exponentially, at a rate between 0 (flat part) and 1 (ideal diode, in
+    # units of kT/q) estimated from the last two secants. The step at most
+    # doubles and is halved after a hard Newton solve. The voltages are not
+    # differentiated.
+    v = lax.stop_gradient(voltages[-3:])
+    j = lax.stop_gradient(currents[-3:])
+    jsc = lax.stop_gradient(currents[0])
+    dv = v[-1] - v[-2]
+    secants = jnp.maximum(jnp.abs(jnp.diff(j)) / jnp.diff(v), 1e-12)
+    if v.size > 2:
+        rate = jnp.clip(
+            jnp.log(secants[1] / secants[0]) / (v[2] - v[0]) * 2, 0, 1)
+    else:
+        rate = 1.
+    slope = secants[-1] * jnp.exp(rate * dv / 2)
+    linear = jtol * jnp.abs(jsc) / slope
+    target = jnp.where(rate > 1e-3,
+                       jnp.log1p(rate * linear) / jnp.maximum(rate, 1e-3),
+                       linear)
+    dvnew = jnp.minimum(target, 2 * dv)
+    dvnew = jnp.where(niter > 8, jnp.minimum(dvnew, dv / 2), dvnew)
+
+    return jnp.clip(dvnew, dv_min / scales.energy, dv_max / scales.energy)
+
+
 def eq_guess(cell: PVCell, bound_eq: Boundary) -> Potentials:
 
     N = cell.Eg.size
@@ -136,6 +186,29 @@ def fwdlnsrch(cell: PVCell,
     return alpha_best
 
 
+@jit
+def armijo(cell: PVCell,
+           bound: Boundary,
+           pot: Potentials,
+           p: Array,
+           resid: f64,
+           c: f64 = 1e-4) -> Tuple[f64, bool]:
+
+    def decrease(alpha):
+        R = residnorm(cell, bound, pot, p, alpha)
+        return R <= (1 - c * alpha) * resid
+
+    def cond_fun(alpha):
+        return jnp.logical_and(alpha > 1e-4, jnp.logical_not(decrease(alpha)))
+
+    def body_fun(alpha):
+        return alpha / 2
+
+    alpha_best = lax.while_loop(cond_fun, body_fun, 1.)
+
+    return alpha_best, decrease(alpha_best)
+
+
 def linguess(pot: Potentials, potl: Potentials):
 
     return Potentials(2 * pot.phi - potl.phi, 2 * pot.phi_n - potl.phi_n,
@@ -149,6 +222,19 @@ def genlinguess(pot: Potentials, potl: Potentials, dx1: f64, dx2: f64):
                       pot.phi_p + (pot.phi_p - potl.phi_p) * dx2 / dx1)
 
 
+def genquadguess(pot: Potentials, potl: Potentials, potll: Potentials, v: f64,
+                 vl: f64, vll: f64, vnew: f64):
+
+    # Lagrange extrapolation through three unequally spaced voltages
+    w = (vnew - vl) * (vnew - vll) / ((v - vl) * (v - vll))
+    wl = (vnew - v) * (vnew - vll) / ((vl - v) * (vl - vll))
+    wll = (vnew - v) * (vnew - vl) / ((vll - v) * (vll - vl))
+
+    return Potentials(w * pot.phi + wl * potl.phi + wll * potll.phi,
+                      w * pot.phi_n + wl * potl.phi_n + wll * potll.phi_n,
+                      w * pot.phi_p + wl * potl.phi_p + wll * potll.phi_p)
+
+
 def quadguess(pot: Potentials, potl: Potentials, potll: Potentials):
 
     f, fn, fp = pot.phi, pot.phi_n, pot.phi_p
@@ -165,8 +251,7 @@ def step_eq_dense(cell: PVCell, bound: Boundary,
 
     Feq = residual.comp_F_eq(cell, bound, pot)
     spJeq = residual.comp_F_eq_deriv(cell, bound, pot)
-    Jeq = linalg.sparse2dense(spJeq)
-    p = jnp.linalg.solve(Jeq, -Feq)
+    p = linalg.bandsol(spJeq, -Feq)
 
     error = jnp.max(jnp.abs(p))
     resid = jnp.linalg.norm(Feq)
@@ -180,12 +265,13 @@ def step_eq_dense(cell: PVCell, bound: Boundary,
 
 
 @jit
+@util.counted
 def step_eq(cell: PVCell, bound: Boundary,
             pot: Potentials) -> Tuple[Potentials, f64]:
 
     Feq = residual.comp_F_eq(cell, bound, pot)
     spJeq = residual.comp_F_eq_deriv(cell, bound, pot)
-    p = linalg.linsol(spJeq, -Feq, tol=1e-6)
+    p = linalg.trisol(spJeq, -Feq)
 
     error = jnp.max(jnp.abs(p))
     resid = jnp.linalg.norm(Feq)
@@ -214,14 +300,76 @@ def solve_eq_dense(cell: PVCell, bound: Boundary,
         logger.info("    iteration {:3d}    |p| = {:.2e}    |F| = {:.2e}".format(niter, error, resid))
 
         if jnp.isnan(error) or error == 0:
-            logger.critical("    Dense solver failed! It's all over.")
+            logger.critical("    Banded LU solver failed! It's all over.")
             raise SystemExit
 
     return pot
 
 
+def zero_tangent(tree):
+
+    def zeros(x):
+        if jnp.issubdtype(jnp.result_type(x), jnp.inexact):
+            return jnp.zeros_like(x)
+        return np.zeros(jnp.shape(x), dtype=jax.dtypes.float0)
+
+    return jax.tree_util.tree_map(zeros, tree)
+
+
+def eq_tangent(cell: PVCell, bound: Boundary, sol: Potentials,
+               dcell: PVCell, dbound: Boundary) -> Potentials:
+
+    zerodpot = Potentials(jnp.zeros_like(sol.phi), jnp.zeros_like(sol.phi_n),
+                          jnp.zeros_like(sol.phi_p))
+
+    _, rhs = jvp(residual.comp_F_eq, (cell, bound, sol),
+                 (dcell, dbound, zerodpot))
+
+    spF_eq_pot = residual.comp_F_eq_deriv(cell, bound, sol)
+    dF_eq = linalg.trisol(spF_eq_pot, -rhs)
+
+    return Potentials(dF_eq, jnp.zeros_like(sol.phi_n),
+                      jnp.zeros_like(sol.phi_p))
+
+
+@jit
+@util.counted
+def newton_eq(cell: PVCell, bound: Boundary,
+              pot_ini: Potentials) -> Tuple[Potentials, dict]:
+
+    def cond_fun(carry):
+        _, stats = carry
+        return jnp.logical_and(stats["niter"] < 100, stats["error"] > 1e-6)
+
+    def body_fun(carry):
+        pot, stats = carry
+        pot, new = step_eq(cell, bound, pot)
+        return pot, {
+            "niter": stats["niter"] + 1,
+            "error": new["error"],
+            "resid": new["resid"]
+        }
+
+    stats_ini = {"niter": i64(0), "error": f64(1), "resid": f64(jnp.inf)}
+    pot, stats = lax.while_loop(cond_fun, body_fun, (pot_ini, stats_ini))
+    stats["converged"] = stats["error"] <= 1e-6
+
+    return pot, stats
+
+
 @custom_jvp
-def solve_eq(cell: PVCell, bound: Boundary, pot_ini: Potentials) -> Potentials:
+def solve_eq(cell: PVCell,
+             bound: Boundary,
+             pot_ini: Potentials,
+             opts: SolverOptions = SolverOptions()) -> Potentials:
+
+    if opts.compiled:
+        pot, stats = newton_eq(cell, bound, pot_ini)
+        logger.info("    {:3d} iterations    |p| = {:.2e}    |F| = {:.2e}".format(int(stats["niter"]), stats["error"], stats["resid"]))
+        if not stats["converged"]:
+            logger.error("    Tridiagonal solver failed! Switching to banded LU.")
+            return solve_eq_dense(cell, bound, pot_ini)
+        return pot
 
     pot = pot_ini
     error = 1
@@ -236,7 +384,7 @@ def solve_eq(cell: PVCell, bound: Boundary, pot_ini: Potentials) -> Potentials:
         logger.info("    iteration {:3d}    |p| = {:.2e}    |F| = {:.2e}".format(niter, error, resid))
 
         if jnp.isnan(error) or error == 0:
-            logger.error("    Sparse solver failed! Switching to dense.")
+            logger.error("    Tridiagonal solver failed! Switching to banded LU.")
             return solve_eq_dense(cell, bound, pot_ini)
 
     return pot
@@ -245,23 +393,82 @@ def solve_eq(cell: PVCell, bound: Boundary, pot_ini: Potentials) -> Potentials:
 @solve_eq.defjvp
 def solve_eq_jvp(primals, tangents):
 
-    cell, bound, pot_ini = primals
-    dcell, dbound, _ = tangents
-    sol = solve_eq(cell, bound, pot_ini)
+    cell, bound, pot_ini, opts = primals
+    dcell, dbound, _, _ = tangents
+    sol = solve_eq(cell, bound, pot_ini, opts)
 
-    zerodpot = Potentials(jnp.zeros_like(sol.phi), jnp.zeros_like(sol.phi_n),
-                          jnp.zeros_like(sol.phi_p))
+    primal_out = sol
+    tangent_out = eq_tangent(cell, bound, sol, dcell, dbound)
 
-    _, rhs = jvp(residual.comp_F_eq, (cell, bound, sol),
-                 (dcell, dbound, zerodpot))
+    return primal_out, tangent_out
+
+
+@partial(custom_vjp, nondiff_argnums=(3, ))
+def solve_eq_reverse(cell: PVCell,
+                     bound: Boundary,
+                     pot_ini: Potentials,
+                     opts: SolverOptions = SolverOptions()) -> Potentials:
+    """Equilibrium solve differentiated in reverse mode, with one transposed tridiagonal solve per cotangent
+
+    Args:
+        cell (PVCell): An initialized cell
+        bound (Boundary): Equilibrium boundary conditions
+        pot_ini (Potentials): Initial guess of solution
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        Potentials: Solution
+    """
+    return solve_eq(cell, bound, pot_ini, opts)
 
+
+def solve_eq_reverse_fwd(cell, bound, pot_ini, opts):
+
+    sol = solve_eq(cell, bound, pot_ini, opts)
+
+    return sol, (cell, bound, sol)
+
+
+def solve_eq_reverse_bwd(opts, res, gsol):
+
+    cell, bound, sol = res
     spF_eq_pot = residual.comp_F_eq_deriv(cell, bound, sol)
-    F_eq_pot = linalg.sparse2dense(spF_eq_pot)
-    dF_eq = jnp.linalg.solve(F_eq_pot, -rhs)
+    lam = linalg.tritsol(spF_eq_pot, gsol.phi)
+    _, F_eq_vjp = vjp(residual.comp_F_eq, cell, bound, sol)
+    dcell, dbound, _ = F_eq_vjp(-lam)
+
+    return dcell, dbound, objects.zero_pot(sol.phi.size)
+
+
+solve_eq_reverse.defvjp(solve_eq_reverse_fwd, solve_eq_reverse_bwd)
 
-    primal_out = sol
-    tangent_out = Potentials(dF_eq, jnp.zeros_like(sol.phi_n),
-                             jnp.zeros_like(sol.phi_p))
+
+@custom_jvp
+def solve_eq_compiled(cell: PVCell, bound: Boundary,
+                      pot_ini: Potentials) -> Tuple[Potentials, dict]:
+    """Differentiable equilibrium solve as a single XLA computation
+
+    Args:
+        cell (PVCell): An initialized cell
+        bound (Boundary): Equilibrium boundary conditions
+        pot_ini (Potentials): Initial guess of solution
+
+    Returns:
+        Tuple[Potentials, dict]: Solution and Newton statistics "niter", "error", "resid" and "converged"
+    """
+    return newton_eq(cell, bound, pot_ini)
+
+
+@solve_eq_compiled.defjvp
+def solve_eq_compiled_jvp(primals, tangents):
+
+    cell, bound, pot_ini = primals
+    dcell, dbound, _ = tangents
+    sol, stats = solve_eq_compiled(cell, bound, pot_ini)
+
+    primal_out = sol, stats
+    tangent_out = (eq_tangent(cell, bound, sol, dcell,
+                              dbound), zero_tangent(stats))
 
     return primal_out, tangent_out
 
@@ -282,6 +489,20 @@ def acceleration(p, pl, dxl, beta):
     return dx
 
 
+def globalize(cell: PVCell, bound: Boundary, pot: Potentials, p: Array,
+              pl: Array, dxl: Array, resid: f64, beta: f64,
+              opts: SolverOptions) -> Tuple[Array, bool]:
+
+    # step and whether the line search found sufficient decrease, falling
+    # back to the full damped step when it did not
+    if opts.globalization == "linesearch":
+        alpha, descent = armijo(cell, bound, pot, p, resid)
+        return jnp.where(descent, alpha, 1.) * p, descent
+    if opts.globalization == "momentum":
+        return acceleration(p, pl, dxl, beta), jnp.array(True)
+    raise ValueError(f"Unknown globalization {opts.globalization}")
+
+
 @jit
 def step_dense(cell: PVCell,
                bound: Boundary,
@@ -292,8 +513,7 @@ def step_dense(cell: PVCell,
 
     F = residual.comp_F(cell, bound, pot)
     spJ = residual.comp_F_deriv(cell, bound, pot)
-    J = linalg.sparse2dense(spJ)
-    p = logdamp(jnp.linalg.solve(J, -F))
+    p = logdamp(linalg.bandsol(spJ, -F))
     dx = acceleration(p, pl, dxl, beta)
     pot_new = modify(pot, dx)
 
@@ -305,7 +525,7 @@ def step_dense(cell: PVCell,
 
 
 def solve_dense(cell: PVCell, bound: Boundary,
-                pot_ini: Potentials) -> Potentials:
+                pot_ini: Potentials) -> Tuple[Potentials, dict]:
 
     pot = pot_ini
     error = 1
@@ -324,77 +544,440 @@ def solve_dense(cell: PVCell, bound: Boundary,
         logger.info("    iteration {:3d}    |p| = {:.2e}    |F| = {:.2e}".format(niter, error, resid))
 
         if jnp.isnan(error) or error == 0:
-            logger.critical("    Dense solver failed! It's all over.")
+            logger.critical("    Banded LU solver failed! It's all over.")
             raise SystemExit
 
+    stats = {
+        "niter": niter,
+        "error": error,
+        "resid": resid,
+        "converged": error <= 1e-6
+    }
+
+    return pot, stats
+
+
+def fallback(cell: PVCell, bound: Boundary, pot_ini: Potentials,
+             state: SolverState) -> Potentials:
+
+    # banded LU from the initial guess after the sparse solver failed, with
+    # its own statistics in place of those of the failed solve
+    logger.error("    Sparse solver failed! Switching to banded LU.")
+    state.fact = None
+    pot, stats = solve_dense(cell, bound, pot_ini)
+    state.stats = dict(stats, fallback=True)
+
     return pot
 
 
 @jit
+@util.counted
 def step(cell: PVCell,
          bound: Boundary,
          pot: Potentials,
          pl: Array,
          dxl: Array,
-         beta: f64 = 0.9) -> Tuple[Potentials, dict]:
+         beta: f64 = 0.9,
+         opts: SolverOptions = SolverOptions()) -> Tuple[Potentials, dict]:
 
     F = residual.comp_F(cell, bound, pot)
     spJ = residual.comp_F_deriv(cell, bound, pot)
-    p = logdamp(linalg.linsol(spJ, -F, tol=1e-6))
-    dx = acceleration(p, pl, dxl, beta)
+    p = logdamp(linalg.spsolve(spJ, -F, opts.linsolver, tol=1e-6))
+    resid = jnp.linalg.norm(F)
+    dx, descent = globalize(cell, bound, pot, p, pl, dxl, resid, beta,
+                            opts)
     pot_new = modify(pot, dx)
 
     error = jnp.max(jnp.abs(p))
+    stats = {
+        "error": error,
+        "resid": resid,
+        "p": p,
+        "dx": dx,
+        "descent": descent
+    }
+
+    return pot_new, stats
+
+
+def forcing(resid: f64, residl: f64, etal: f64, opts: SolverOptions) -> f64:
+
+    if opts.forcing == "fixed":
+        return f64(1e-6)
+
+    # Eisenstat-Walker choice 2 with its safeguard against oversolving
+    eta = 0.9 * (resid / residl)**2
+    safe = 0.9 * etal**2
+    eta = jnp.where(safe > 0.1, jnp.maximum(eta, safe), eta)
+
+    return jnp.clip(eta, 1e-6, 0.9)
+
+
+def precsolve(mvp: Callable[[Array], Array], jac: Callable[[], Array],
+              rhs: Array, fact: Array, fresh: bool, tol: f64,
+              opts: SolverOptions) -> Tuple[Array, Array, i64, bool]:
+
+    def krylov(fact):
+        return linalg.ilusol(mvp, rhs, fact, tol=tol)
+
+    fact = lax.cond(fresh, lambda _: linalg.spilu(jac()), lambda _: fact,
+                    None)
+    sol, lin_iters, relres = krylov(fact)
+
+    # refactor only once the stale preconditioner stops paying for itself
+    stale = jnp.logical_and(
+        jnp.logical_not(fresh),
+        jnp.logical_or(lin_iters > opts.refactor_iters, relres > tol))
+
+    def refactor(_):
+        fact_new = linalg.spilu(jac())
+        sol_new, iters_new, _ = krylov(fact_new)
+        return sol_new, fact_new, lin_iters + iters_new
+
+    sol, fact, lin_iters = lax.cond(stale, refactor,
+                                    lambda _: (sol, fact, lin_iters), None)
+
+    return sol, fact, lin_iters, jnp.logical_or(fresh, stale)
+
+
+@jit
+@util.counted
+def step_reuse(cell: PVCell,
+               bound: Boundary,
+               pot: Potentials,
+               pl: Array,
+               dxl: Array,
+               fact: Array,
+               fresh: bool,
+               residl: f64 = jnp.inf,
+               etal: f64 = 0.5,
+               beta: f64 = 0.9,
+               opts: SolverOptions = SolverOptions()) -> Tuple[Potentials, dict]:
+
+    if not opts.reuse_precond:
+        fresh = True
+
+    F = residual.comp_F(cell, bound, pot)
+    spJ = residual.comp_F_deriv(cell, bound, pot)
     resid = jnp.linalg.norm(F)
-    stats = {"error": error, "resid": resid, "p": p, "dx": dx}
+    eta = forcing(resid, residl, etal, opts)
+    sol, fact, lin_iters, refactored = precsolve(
+        partial(linalg.spmatvec, spJ), lambda: spJ, -F, fact, fresh, eta,
+        opts)
+
+    p = logdamp(sol)
+    dx, descent = globalize(cell, bound, pot, p, pl, dxl, resid, beta,
+                            opts)
+    pot_new = modify(pot, dx)
+
+    error = jnp.max(jnp.abs(p))
+    stats = {
+        "error": error,
+        "resid": resid,
+        "p": p,
+        "dx": dx,
+        "fact": fact,
+        "eta": eta,
+        "linear_iters": lin_iters,
+        "refactored": refactored,
+        "descent": descent
+    }
 
     return pot_new, stats
 
 
-@custom_jvp
-def solve(cell: PVCell, bound: Boundary, pot_ini: Potentials) -> Potentials:
+def residvec(cell: PVCell, bound: Boundary) -> Callable[[Array], Array]:
 
+    return lambda vec: residual.comp_F(cell, bound, vec2pot(vec))
+
+
+@jit
+@util.counted
+def step_jfnk(cell: PVCell,
+              bound: Boundary,
+              pot: Potentials,
+              pl: Array,
+              dxl: Array,
+              fact: Array,
+              fresh: bool,
+              residl: f64 = jnp.inf,
+              etal: f64 = 0.5,
+              beta: f64 = 0.9,
+              opts: SolverOptions = SolverOptions()) -> Tuple[Potentials, dict]:
+
+    # Jacobian-free: matvecs are jvps of the residual, and the preconditioner
+    # is factored from a band Jacobian colored out of the same jvps
+    fun = residvec(cell, bound)
+    vec = pot2vec(pot)
+    F, mvp = jax.linearize(fun, vec)
+    resid = jnp.linalg.norm(F)
+    eta = forcing(resid, residl, etal, opts)
+    sol, fact, lin_iters, refactored = precsolve(
+        mvp, lambda: linalg.jacband(fun, vec), -F, fact, fresh, eta, opts)
+
+    p = logdamp(sol)
+    dx, descent = globalize(cell, bound, pot, p, pl, dxl, resid, beta,
+                            opts)
+    pot_new = modify(pot, dx)
+
+    error = jnp.max(jnp.abs(p))
+    stats = {
+        "error": error,
+        "resid": resid,
+        "p": p,
+        "dx": dx,
+        "fact": fact,
+        "eta": eta,
+        "linear_iters": lin_iters,
+        "refactored": refactored,
+        "descent": descent
+    }
+
+    return pot_new, stats
+
+
+def jacobian(cell: PVCell, bound: Boundary, pot: Potentials,
+             opts: SolverOptions) -> Array:
+
+    if opts.linsolver == "jfnk":
+        return linalg.jacband(residvec(cell, bound), pot2vec(pot))
+
+    return residual.comp_F_deriv(cell, bound, pot)
+
+
+def tangent(cell: PVCell,
+            bound: Boundary,
+            sol: Potentials,
+            dcell: PVCell,
+            dbound: Boundary,
+            opts: SolverOptions = SolverOptions()) -> Potentials:
+
+    zerodpot = Potentials(jnp.zeros_like(sol.phi), jnp.zeros_like(sol.phi_n),
+                          jnp.zeros_like(sol.phi_p))
+
+    _, rhs = jvp(residual.comp_F, (cell, bound, sol),
+                 (dcell, dbound, zerodpot))
+
+    spF_pot = jacobian(cell, bound, sol, opts)
+    dF = linalg.bandsol(spF_pot, -rhs)
+
+    return Potentials(dF[2::3], dF[0::3], dF[1::3])
+
+
+def iterative(opts: SolverOptions) -> bool:
+
+    # whether Newton steps go through pgmres, which counts its iterations
+    krylov = opts.reuse_precond or opts.linsolver == "jfnk" or opts.forcing == "ew"
+    if opts.forcing not in ("fixed", "ew"):
+        raise ValueError(f"Unknown forcing term {opts.forcing}")
+    if opts.reuse_precond and opts.linsolver not in ("gmres", "jfnk"):
+        raise ValueError(
+            f"Preconditioner reuse needs an iterative linear solver, not {opts.linsolver}"
+        )
+    if opts.forcing == "ew" and opts.linsolver not in ("gmres", "jfnk"):
+        raise ValueError(
+            f"Eisenstat-Walker forcing needs an iterative linear solver, not {opts.linsolver}"
+        )
+
+    return krylov
+
+
+@jit
+@util.counted
+def newton(cell: PVCell,
+           bound: Boundary,
+           pot_ini: Potentials,
+           opts: SolverOptions = SolverOptions(),
+           fact: Array = None,
+           fresh: bool = True) -> Tuple[Potentials, dict]:
+
+    # a preconditioner passed in is kept across voltages, as in solve, and
+    # returned in the statistics
+    krylov = iterative(opts)
+    linesearch = opts.globalization == "linesearch"
+
+    def cond_fun(carry):
+        _, _, _, _, stats = carry
+        return jnp.logical_and(stats["niter"] < 100, stats["error"] > 1e-6)
+
+    def body_fun(carry):
+        pot, pl, dxl, fact, stats = carry
+        if krylov:
+            stepper = step_jfnk if opts.linsolver == "jfnk" else step_reuse
+            pot, new = stepper(cell,
+                               bound,
+                               pot,
+                               pl,
+                               dxl,
+                               fact,
+                               jnp.logical_and(fresh, stats["niter"] == 0),
+                               stats["resid"],
+                               stats["eta"],
+                               opts=opts)
+            fact = new["fact"]
+        else:
+            pot, new = step(cell, bound, pot, pl, dxl, opts=opts)
+        stats_new = {
+            "niter": stats["niter"] + 1,
+            "error": new["error"],
+            "resid": new["resid"]
+        }
+        if krylov:
+            stats_new["eta"] = new["eta"]
+            stats_new["linear_iters"] = stats["linear_iters"] + new[
+                "linear_iters"]
+        if linesearch:
+            stats_new["linesearch_failures"] = stats[
+                "linesearch_failures"] + jnp.logical_not(new["descent"])
+        return pot, new["p"], new["dx"], fact, stats_new
+
+    N = pot_ini.phi.size
+    zeros = jnp.zeros(3 * N)
+    fact_ini = jnp.zeros((3 * N, linalg._W)) if fact is None else fact
+    stats_ini = {"niter": i64(0), "error": f64(1), "resid": f64(jnp.inf)}
+    if krylov:
+        stats_ini["eta"] = f64(0.5)
+        stats_ini["linear_iters"] = i64(0)
+    if linesearch:
+        stats_ini["linesearch_failures"] = i64(0)
+    pot, _, _, fact_out, stats = lax.while_loop(
+        cond_fun, body_fun, (pot_ini, zeros, zeros, fact_ini, stats_ini))
+    stats["converged"] = stats["error"] <= 1e-6
+    if fact is not None:
+        stats["fact"] = fact_out
+
+    return pot, stats
+
+
+@partial(custom_jvp, nondiff_argnums=(4, ))
+def solve(cell: PVCell,
+          bound: Boundary,
+          pot_ini: Potentials,
+          opts: SolverOptions = SolverOptions(),
+          state: SolverState = None) -> Potentials:
+
+    if state is None:
+        state = SolverState()
+
+    if opts.compiled:
+        if iterative(opts):
+            N = pot_ini.phi.size
+            fresh = state.fact is None or state.fact.shape[0] != 3 * N
+            fact = jnp.zeros((3 * N, linalg._W)) if fresh else state.fact
+            pot, stats = newton(cell, bound, pot_ini, opts, fact, fresh)
+            state.fact = stats.pop("fact")
+        else:
+            pot, stats = newton(cell, bound, pot_ini, opts)
+        logger.info("    {:3d} iterations    |p| = {:.2e}    |F| = {:.2e}".format(int(stats["niter"]), stats["error"], stats["resid"]))
+        if "linear_iters" in stats:
+            logger.info("    {:3d} GMRES iterations".format(int(stats["linear_iters"])))
+        if stats.get("linesearch_failures", 0) > 0:
+            logger.warning("    Line search failed in {:3d} iterations, took full steps".format(int(stats["linesearch_failures"])))
+        if not stats["converged"]:
+            return fallback(cell, bound, pot_ini, state)
+        state.stats = dict(stats, fallback=False)
+        return pot
+
+    N = pot_ini.phi.size
     pot = pot_ini
     error = 1
     niter = 0
-    pl = jnp.zeros(3 * pot.phi.size)
-    dxl = jnp.zeros(3 * pot.phi.size)
+    pl = jnp.zeros(3 * N)
+    dxl = jnp.zeros(3 * N)
+
+    krylov = iterative(opts)
+    stepper = step_jfnk if opts.linsolver == "jfnk" else step_reuse
+    failures = 0
+
+    if krylov:
+        fresh = state.fact is None or state.fact.shape[0] != 3 * N
+        fact = jnp.zeros((3 * N, linalg._W)) if fresh else state.fact
+        resid, eta = jnp.inf, 0.5
+        lin_iters = []
+        refactors = 0
 
     while niter < 100 and error > 1e-6:
 
-        pot, stats = step(cell, bound, pot, pl, dxl)
+        if krylov:
+            pot, stats = stepper(cell, bound, pot, pl, dxl, fact, fresh, resid, eta, opts=opts)
+            fact, fresh, eta = stats["fact"], False, stats["eta"]
+            lin_iters.append(int(stats["linear_iters"]))
+            refactors += int(stats["refactored"])
+        else:
+            pot, stats = step(cell, bound, pot, pl, dxl, opts=opts)
         error = stats["error"]
         resid = stats["resid"]
         pl = stats["p"]
         dxl = stats["dx"]
         niter += 1
-        logger.info("    iteration {:3d}    |p| = {:.2e}    |F| = {:.2e}".format(niter, error, resid))
+        if not stats["descent"]:
+            failures += 1
+            logger.warning("    Line search failed, taking full step")
+        if krylov:
+            logger.info("    iteration {:3d}    |p| = {:.2e}    |F| = {:.2e}    eta = {:.1e}    GMRES iterations = {:3d}".format(niter, error, resid, eta, lin_iters[-1]))
+        else:
+            logger.info("    iteration {:3d}    |p| = {:.2e}    |F| = {:.2e}".format(niter, error, resid))
 
         if jnp.isnan(error) or error == 0:
-            logger.error("    Sparse solver failed! Switching to dense.")
-            return solve_dense(cell, bound, pot_ini)
+            return fallback(cell, bound, pot_ini, state)
+
+    state.stats = {"niter": niter, "error": error, "resid": resid,
+                   "converged": error <= 1e-6, "fallback": False}
+    if opts.globalization == "linesearch":
+        state.stats["linesearch_failures"] = failures
+
+    if krylov:
+        state.fact = fact
+        state.stats.update(linear_iters=sum(lin_iters),
+                           linear_iters_per_step=lin_iters,
+                           refactors=refactors)
+        logger.info("    {:3d} GMRES iterations, {:2d} factorizations".format(sum(lin_iters), refactors))
 
     return pot
 
 
 @solve.defjvp
-def solve_jvp(primals, tangents):
+def solve_jvp(state, primals, tangents):
 
-    cell, bound, pot_ini = primals
-    dcell, dbound, _ = tangents
-    sol = solve(cell, bound, pot_ini)
+    cell, bound, pot_ini, opts = primals
+    dcell, dbound, _, _ = tangents
+    sol = solve(cell, bound, pot_ini, opts, state)
 
-    zerodpot = Potentials(jnp.zeros_like(sol.phi), jnp.zeros_like(sol.phi_n),
-                          jnp.zeros_like(sol.phi_p))
+    primal_out = sol
+    tangent_out = tangent(cell, bound, sol, dcell, dbound, opts)
 
-    _, rhs = jvp(residual.comp_F, (cell, bound, sol),
-                 (dcell, dbound, zerodpot))
+    return primal_out, tangent_out
 
-    spF_pot = residual.comp_F_deriv(cell, bound, sol)
-    F_pot = linalg.sparse2dense(spF_pot)
-    dF = jnp.linalg.solve(F_pot, -rhs)
 
-    primal_out = sol
-    tangent_out = Potentials(dF[2::3], dF[0::3], dF[1::3])
+@custom_jvp
+def solve_compiled(
+        cell: PVCell,
+        bound: Boundary,
+        pot_ini: Potentials,
+        opts: SolverOptions = SolverOptions()) -> Tuple[Potentials, dict]:
+    """Differentiable PDD solve as a single XLA computation, which can be vmapped
+
+    Args:
+        cell (PVCell): An initialized cell
+        bound (Boundary): Boundary conditions
+        pot_ini (Potentials): Initial guess of solution
+        opts (SolverOptions, optional): Nonlinear and linear solver settings. Defaults to SolverOptions().
+
+    Returns:
+        Tuple[Potentials, dict]: Solution and Newton statistics "niter", "error", "resid" and "converged"
+    """
+    return newton(cell, bound, pot_ini, opts)
+
+
+@solve_compiled.defjvp
+def solve_compiled_jvp(primals, tangents):
+
+    cell, bound, pot_ini, opts = primals
+    dcell, dbound, _, _ = tangents
+    sol, stats = solve_compiled(cell, bound, pot_ini, opts)
+
+    primal_out = sol, stats
+    tangent_out = (tangent(cell, bound, sol, dcell, dbound,
+                           opts), zero_tangent(stats))
 
     return primal_out, tangent_out
@@ -11,7 +11,7 @@ def quadratic(x, coef):
     return y
 
 
-def qspline(x, y):
+def qspline(x, y, mask=None):
 
     n = x.size
     M = jnp.zeros((3 * (n - 1), 3 * (n - 1)))
@@ -31,6 +31,12 @@ def qspline(x, y):
         M = M.at[3 * i + 3, 3 * i:3 * i + 6].set(
             jnp.array([2 * x[i + 1], 1, 0, -2 * x[i + 1], -1, 0]))
 
+    if mask is not None:
+        # decouple the segments past the last valid point and zero them
+        rows = jnp.repeat(jnp.logical_not(mask[1:]), 3)
+        M = jnp.where(rows.reshape(-1, 1), jnp.eye(3 * (n - 1)), M)
+        z = jnp.where(rows, 0, z)
+
     coef = jnp.linalg.solve(M, z)
     a = coef[::3]
     b = coef[1::3]
@@ -61,7 +67,7 @@ def ascent(df, x0=0., lr=1., tol=1e-6, niter=100):
     return x
 
 
-def findmax(x, coef):
+def findmax(x, coef, mask=None):
 
     a, b, _ = coef
     xl = x[:-1]
@@ -75,6 +81,8 @@ def findmax(x, coef):
 
     xall = jnp.concatenate([xl, xu, xm])
     yall = jnp.concatenate([yl, yu, ym])
+    if mask is not None:
+        yall = jnp.where(jnp.tile(mask[1:], 3), yall, -jnp.inf)
 
     idxmax = jnp.argmax(yall)
     ymax = yall[idxmax]
@@ -94,10 +102,10 @@ def calcPmax_gd(v, j):
     return pmax
 
 
-def calcPmax(v, j):
+def calcPmax(v, j, mask=None):
     p = v * j
-    coef = qspline(v, p)
-    pmax, vmax = findmax(v, coef)
+    coef = qspline(v, p, mask)
+    pmax, vmax = findmax(v, coef, mask)
     return pmax, vmax
 
 
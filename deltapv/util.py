@@ -3,6 +3,9 @@ from jax.experimental import optimizers
 import jax
 import numpy as np
 from deltapv import spline, simulator
+from typing import Callable
+import collections
+import functools
 from scipy.optimize import minimize
 import matplotlib.pyplot as plt
 import logging
@@ -12,6 +15,30 @@ Array = jnp.ndarray
 f64 = jnp.float64
 i64 = jnp.int64
 
+compiles = collections.Counter()
+
+
+def counted(fun: Callable) -> Callable:
+
+    # Counts the traces of fun, one per compilation when fun is jitted
+    name = fun.__module__.split(".")[-1] + "." + fun.__name__
+
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        compiles[name] += 1
+        return fun(*args, **kwargs)
+
+    return wrapper
+
+
+def bucket(n: int) -> int:
+
+    # Round up to the next of eight sizes per octave, so that padding costs
+    # at most 12.5% more nodes
+    step = 2**max(n.bit_length() - 4, 0)
+
+    return -(-n // step) * step
+
 
 def print_ascii():
     print(
@@ -1,10 +1,47 @@
 import unittest
 import deltapv as dpv
 from jax import numpy as jnp
+import jax
 import numpy as np
+from functools import partial
 from scipy.optimize import minimize
 from optimize import psc
 from optimize import multi
+from deltapv import linalg, simulator, solver, adjoint, bcond, scales
+
+
+def random_banded(n, seed=0):
+    # Block-tridiagonal test matrix with the sparsity of the PDD Jacobian
+    rng = np.random.RandomState(seed)
+    m = rng.uniform(-1, 1, size=(n, linalg._W))
+    m[:, linalg._W // 2] += 10
+    rows = np.arange(n).reshape(-1, 1)
+    cols = rows + np.arange(linalg._W) - linalg._W // 2
+    node = rows // 3
+    m[(cols < 0) | (cols >= n) | (np.abs(cols // 3 - node) > 1)] = 0
+    return jnp.array(m)
+
+
+def pn_junction(n_points, Eg=1.5, tau=1e-8):
+    material = dpv.create_material(Chi=3.9,
+                                   Eg=Eg,
+                                   eps=9.4,
+                                   Nc=8e17,
+                                   Nv=1.8e19,
+                                   mn=100,
+                                   mp=100,
+                                   Et=0,
+                                   tn=tau,
+                                   tp=tau,
+                                   A=1e4)
+    return dpv.make_design(n_points=n_points,
+                           Ls=[5e-6, 3e-4 - 5e-6],
+                           mats=[material, material],
+                           Ns=[1e17, -1e15],
+                           Snl=1e7,
+                           Snr=0,
+                           Spl=0,
+                           Spr=1e7)
 
 
 class TestDeltaPV(unittest.TestCase):
@@ -53,6 +90,237 @@ class TestDeltaPV(unittest.TestCase):
         self.assertTrue(jnp.allclose(v, v_correct), "Voltages do not match!")
         self.assertTrue(jnp.allclose(j, j_correct), "Currents do not match!")
 
+    def test_compiled(self):
+        design = pn_junction(100)
+        _, j_correct = dpv.simulate(design, verbose=False)["iv"]
+        opts = dpv.SolverOptions(compiled=True)
+        _, j = dpv.simulate(design, verbose=False, opts=opts)["iv"]
+        self.assertTrue(jnp.allclose(j, j_correct), "Currents do not match!")
+
+    def test_compiled_reuse(self):
+        design = pn_junction(100)
+        _, j_correct = dpv.simulate(design, verbose=False)["iv"]
+        opts = dpv.SolverOptions(compiled=True, reuse_precond=True)
+        _, j = dpv.simulate(design, verbose=False, opts=opts)["iv"]
+        self.assertTrue(jnp.allclose(j, j_correct), "Currents do not match!")
+
+    def test_linesearch(self):
+        # cold start at 0.5 V, which the momentum heuristic cannot solve
+        design = pn_junction(200)
+        ls = simulator.incident_light()
+        cell = simulator.init_cell(design, ls)
+        guess = solver.ooe_guess(cell, simulator.equilibrium(design, ls))
+        opts = dpv.SolverOptions(linsolver="lu", globalization="linesearch")
+        state = solver.SolverState()
+        solver.solve(cell, bcond.boundary(cell, 0.5 / scales.energy), guess,
+                     opts, state)
+        self.assertTrue(state.stats["error"] <= 1e-6, "Newton did not converge!")
+
+    def test_reverse(self):
+        ls = simulator.incident_light()
+
+        def current(Eg, reverse):
+            design = pn_junction(100, Eg)
+            opts = dpv.SolverOptions(reverse=reverse)
+            cell = simulator.init_cell(design, ls)
+            guess = solver.ooe_guess(cell,
+                                     simulator.equilibrium(design, ls, opts))
+            solve_pdd = adjoint.solve_pdd_reverse if reverse else adjoint.solve_pdd
+            return solve_pdd(cell, 0.1 / scales.energy, guess, opts)[0]
+
+        g_fwd = jax.jacfwd(current)(1.5, False)
+        g_rev = jax.grad(current)(1.5, True)
+        self.assertTrue(jnp.allclose(g_fwd, g_rev), "Gradients do not match!")
+
+    def test_eff_and_grad(self):
+        design = jax.tree_util.tree_map(jnp.asarray, pn_junction(100))
+        eff, grad = dpv.eff_and_grad(design, verbose=False)
+        grad_correct = jax.grad(
+            lambda d: dpv.simulate(d, verbose=False)["eff"])(design)
+        self.assertTrue(jnp.allclose(grad.Eg, grad_correct.Eg, rtol=1e-5),
+                        "Gradients do not match!")
+
+    def test_iv_jacobian(self):
+        fun = lambda theta: pn_junction(80, theta[0], 10**theta[1])
+        theta = jnp.array([1.5, -8.])
+        opts = dpv.SolverOptions(linsolver="lu")
+        _, _, jac = dpv.iv_jacobian(fun, theta, verbose=False, opts=opts)
+        current = lambda theta: dpv.simulate(
+            fun(theta), n_steps=jac.shape[0], verbose=False, opts=opts)["iv"][1]
+        eps = 1e-4
+        jac_correct = jnp.stack([(current(theta + eps * e) -
+                                  current(theta - eps * e)) / (2 * eps)
+                                 for e in jnp.eye(2)],
+                                axis=1)
+        self.assertTrue(jnp.allclose(jac, jac_correct, rtol=1e-4, atol=1e-7),
+                        "Jacobians do not match!")
+
+    def test_eff_hvp(self):
+        fun = lambda theta: pn_junction(80, theta[0], 10**theta[1])
+        theta = jnp.array([1.5, -8.])
+        vec = jnp.array([1., -0.5])
+        ls = simulator.incident_light()
+        opts = dpv.SolverOptions(linsolver="lu")
+        cell = simulator.init_cell(fun(theta), ls)
+        guess = solver.ooe_guess(cell, simulator.equilibrium(fun(theta), ls))
+        grad = lambda theta: dpv.eff_hvp(
+            fun, theta, vec, 0.1, guess, verbose=False, opts=opts)[1]
+        _, _, hvp = dpv.eff_hvp(fun, theta, vec, 0.1, guess, verbose=False,
+                                opts=opts)
+        eps = 1e-4
+        hvp_correct = (grad(theta + eps * vec) -
+                       grad(theta - eps * vec)) / (2 * eps)
+        self.assertTrue(jnp.allclose(hvp, hvp_correct, rtol=1e-4),
+                        "Hessian-vector products do not match!")
+
+    def test_sweep(self):
+        design = pn_junction(100)
+        opts = dpv.SolverOptions(linsolver="lu")
+        results = dpv.sweep(design, n_steps=10, opts=opts)
+        _, j_correct = dpv.simulate(design, n_steps=10, opts=opts)["iv"]
+        self.assertTrue(results["converged"].all(), "Sweep did not converge!")
+        self.assertTrue(jnp.allclose(results["iv"][1], j_correct),
+                        "Currents do not match!")
+
+    def test_sweep_parallel(self):
+        design = pn_junction(100)
+        opts = dpv.SolverOptions(linsolver="lu")
+        results = dpv.sweep_parallel(design, n_steps=10, opts=opts)
+        _, j_correct = dpv.sweep(design, n_steps=10, opts=opts)["iv"]
+        self.assertTrue(results["converged"].all(), "Sweep did not converge!")
+        self.assertTrue(jnp.allclose(results["iv"][1], j_correct),
+                        "Currents do not match!")
+
+    def test_simulate_batch(self):
+        designs = [pn_junction(100, Eg) for Eg in [1.3, 1.7]]
+        opts = dpv.SolverOptions(linsolver="lu")
+        results = dpv.simulate_batch(designs, opts=opts)
+        eff_correct = jnp.array([
+            dpv.simulate(design, opts=opts)["eff"] for design in designs
+        ])
+        self.assertTrue(results["converged"].all(), "Batch did not converge!")
+        self.assertTrue(jnp.allclose(results["eff"], eff_correct),
+                        "Efficiencies do not match!")
+
+    def test_pad_design(self):
+        opts = dpv.SolverOptions(linsolver="lu")
+        _, j_correct = dpv.simulate(pn_junction(90), opts=opts)["iv"]
+        _, j = dpv.simulate(dpv.pad_design(pn_junction(90)), opts=opts)["iv"]
+        self.assertTrue(jnp.allclose(j, j_correct), "Currents do not match!")
+        compiles = dict(dpv.util.compiles)
+        dpv.simulate(dpv.pad_design(pn_junction(93)), opts=opts)
+        self.assertEqual(dict(dpv.util.compiles), compiles,
+                         "Padded design was recompiled!")
+
+    def test_prepare(self):
+        ls = simulator.incident_light()
+        cell = simulator.prepare(pn_junction(100), ls)
+        self.assertIs(simulator.prepare(pn_junction(100), ls), cell,
+                      "Cell was not reused!")
+        self.assertIsNot(simulator.prepare(pn_junction(100, Eg=1.4), ls),
+                         cell, "Cell of a different design was reused!")
+
+    def test_adaptive(self):
+        design = pn_junction(100)
+        opts = dpv.SolverOptions(linsolver="lu")
+        results = dpv.simulate(design, opts=opts)
+        adaptive = dpv.simulate(design, opts=opts, adaptive=True)
+        self.assertTrue(jnp.allclose(adaptive["eff"], results["eff"],
+                                     rtol=1e-3), "Efficiencies do not match!")
+        self.assertLess(adaptive["iv"][0].size, results["iv"][0].size,
+                        "Adaptive stepping did not save solves!")
+
+    def test_simulate_iter(self):
+        design = pn_junction(100)
+        opts = dpv.SolverOptions(linsolver="lu")
+        v, j = dpv.simulate(design, n_steps=5, opts=opts)["iv"]
+        points = list(dpv.simulate_iter(design, n_steps=5, opts=opts))
+        self.assertEqual(len(points), 5, "Wrong number of bias points!")
+        self.assertTrue(all(point["stats"]["converged"] for point in points),
+                        "Bias points did not converge!")
+        self.assertTrue(jnp.allclose(jnp.stack([p["v"] for p in points]), v),
+                        "Voltages do not match!")
+        self.assertTrue(jnp.allclose(jnp.stack([p["j"] for p in points]), j),
+                        "Currents do not match!")
+
+    def test_mpp(self):
+        opts = dpv.SolverOptions(linsolver="lu")
+        eff = lambda Eg: dpv.mpp(pn_junction(100, Eg), opts=opts)["eff"]
+        eff_correct = dpv.simulate(pn_junction(100), opts=opts)["eff"]
+        self.assertTrue(jnp.allclose(eff(1.5), eff_correct, rtol=1e-3),
+                        "Efficiencies do not match!")
+        grad_correct = (eff(1.5001) - eff(1.4999)) / 2e-4
+        self.assertTrue(jnp.allclose(jax.grad(eff)(1.5), grad_correct,
+                                     rtol=1e-3), "Gradients do not match!")
+
+    def test_jsc_voc(self):
+        design = pn_junction(100)
+        opts = dpv.SolverOptions(linsolver="lu")
+        v, j = dpv.simulate(design, opts=opts)["iv"]
+        self.assertTrue(jnp.allclose(dpv.jsc(design, opts=opts), j[0]),
+                        "Short-circuit currents do not match!")
+        voc = dpv.voc(design, opts=opts)
+        self.assertTrue(v[-2] < voc < v[-1],
+                        "Open-circuit voltage is not bracketed by the sweep!")
+
+    def test_block_thomas(self):
+        m = random_banded(300)
+        b = jnp.linspace(-1, 1, 300)
+        x_correct = jnp.linalg.solve(linalg.sparse2dense(m), b)
+        x = linalg.btsol(m, b)
+        self.assertTrue(jnp.allclose(x, x_correct), "Solutions do not match!")
+
+    def test_cyclic_reduction(self):
+        m = random_banded(303)
+        b = jnp.stack([jnp.linspace(-1, 1, 303), jnp.ones(303)], axis=1)
+        x_correct = jnp.linalg.solve(linalg.sparse2dense(m), b)
+        x = linalg.pcrsol(m, b)
+        self.assertTrue(jnp.allclose(x, x_correct), "Solutions do not match!")
+
+    def test_thomas(self):
+        m = random_banded(300)
+        m = m * (jnp.abs(jnp.arange(linalg._W) - linalg._W // 2) <= 1)
+        b = jnp.linspace(-1, 1, 300)
+        x_correct = jnp.linalg.solve(linalg.sparse2dense(m), b)
+        x = linalg.trisol(m, b)
+        self.assertTrue(jnp.allclose(x, x_correct), "Solutions do not match!")
+
+    def test_banded_lu(self):
+        m = random_banded(300, seed=1)
+        m = m.at[:, linalg._W // 2].add(-10)  # force row exchanges
+        a = linalg.sparse2dense(m)
+        b = jnp.stack([jnp.linspace(-1, 1, 300), jnp.ones(300)], axis=1)
+        fact = linalg.bandlu(m)
+        self.assertTrue(jnp.allclose(linalg.lusolve(fact, b),
+                                     jnp.linalg.solve(a, b)),
+                        "Solutions do not match!")
+        self.assertTrue(jnp.allclose(linalg.lutsolve(fact, b),
+                                     jnp.linalg.solve(a.T, b)),
+                        "Transposed solutions do not match!")
+
+    def test_stale_precond(self):
+        m = random_banded(300, seed=2)
+        b = jnp.linspace(-1, 1, 300)
+        fact = linalg.spilu(random_banded(300, seed=3))
+        sol, niter, relres = linalg.ilusol(partial(linalg.spmatvec, m),
+                                           b,
+                                           fact,
+                                           tol=1e-10)
+        self.assertTrue(relres <= 1e-10, "GMRES did not converge!")
+        self.assertTrue(niter > 1, "Stale preconditioner should not be exact!")
+        self.assertTrue(jnp.allclose(sol,
+                                     jnp.linalg.solve(linalg.sparse2dense(m),
+                                                      b)),
+                        "Solutions do not match!")
+
+    def test_jacband(self):
+        m = random_banded(300, seed=4)
+        fun = lambda x: linalg.spmatvec(m, x) + x**3
+        x = jnp.linspace(-1, 1, 300)
+        jac = m.at[:, linalg._W // 2].add(3 * x**2)
+        self.assertTrue(jnp.allclose(linalg.jacband(fun, x), jac),
+                        "Band Jacobians do not match!")
+
     def test_psc(self):
         bounds = [(1, 5), (1, 5), (1, 20), (17, 20), (17, 20), (0, 3), (0, 3),
                   (1, 5), (1, 5), (1, 20), (17, 20), (17, 20), (0, 3), (0, 3),